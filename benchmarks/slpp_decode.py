@@ -0,0 +1,63 @@
+# Compares the fast and the slow Lua decoders on a KOReader sidecar with many highlights, and the fast decoder reading only some keys.
+# Run from the plugin folder: python benchmarks/slpp_decode.py [highlights]
+
+import os, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from slpp import slpp as lua
+
+
+
+def make_sidecar(highlights):
+    annotations = []
+    for i in range(highlights):
+        annotations.append({
+            "chapter": "Chapter " + str(i // 10),
+            "color": "yellow",
+            "datetime": "2024-01-01 12:00:00",
+            "drawer": "lighten",
+            "note": "Note with \"quotes\" and a \\ backslash " + str(i),
+            "page": "/body/DocFragment[" + str(i) + "]/body/p[3]/text().0",
+            "pageno": i,
+            "pos0": "/body/DocFragment[" + str(i) + "]/body/p[3]/text().0",
+            "pos1": "/body/DocFragment[" + str(i) + "]/body/p[3]/text().120",
+            "text": "Some highlighted text " * 5
+        })
+    sidecar = {
+        "annotations": annotations,
+        "cre_dom_version": 20240114,
+        "doc_path": "/mnt/ext1/Books/Book.epub",
+        "doc_props": {"authors": "Author", "language": "en", "title": "Book"},
+        "last_xpointer": "/body/DocFragment[12]/body/p[3]/text().0",
+        "percent_finished": 0.5,
+        "stats": {"highlights": highlights, "notes": highlights, "pages": 300},
+        "summary": {"modified": "2024-01-01", "rating": 4, "status": "reading"}
+    }
+    return lua.encode(sidecar)
+
+
+
+def measure(decode, text, repeat):
+    start = time.time()
+    for i in range(repeat):
+        result = decode(text)
+    return (time.time() - start) / repeat, result
+
+
+
+if __name__ == "__main__":
+    highlights = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    text = make_sidecar(highlights)
+
+    slow_time, slow_result = measure(lua.slow_decode, text, 3)
+    fast_time, fast_result = measure(lua.decode, text, 3)
+    keys_time, keys_result = measure(lambda text: lua.decode(text, ["summary", "last_xpointer"]), text, 3)
+
+    print("Sidecar size: " + str(len(text)) + " characters, " + str(highlights) + " highlights")
+    print("Slow decoder: %.3f s" % slow_time)
+    print("Fast decoder: %.3f s" % fast_time)
+    print("Speedup: %.1fx" % (slow_time / fast_time))
+    print("Same result: " + str(slow_result == fast_result))
+    print("Fast decoder, summary and last_xpointer only: %.3f s" % keys_time)
+    print("Speedup: %.1fx" % (slow_time / keys_time))
+    print("Same result: " + str(all(keys_result[key] == slow_result[key] for key in keys_result)))
@@ -37,6 +37,7 @@ prefs.defaults['sync_cr_pos'] = False
 prefs.defaults['sync_cr_an'] = False
 prefs.defaults['prefer_kr_shelf'] = False
 prefs.defaults['prefer_kr_fav'] = False
+prefs.defaults['local_db_copy'] = False
 
 
 class ConfigWidget(QWidget):
@@ -124,6 +125,10 @@ class ConfigWidget(QWidget):
         self.sync_pb_an_checkbox.setChecked(prefs['sync_pb_an'])
         main_layout.addWidget(self.sync_pb_an_checkbox, 6, 0, 1, 2)
 
+        self.local_db_copy_checkbox = QCheckBox("Sync with a local copy of the device database and write it back at the end")
+        self.local_db_copy_checkbox.setChecked(prefs['local_db_copy'])
+        main_layout.addWidget(self.local_db_copy_checkbox, 7, 0, 1, 2)
+
 
         # KOReader settings
 
@@ -256,6 +261,7 @@ class ConfigWidget(QWidget):
         prefs['sync_cr_an'] = self.sync_cr_an_checkbox.isChecked()
         prefs['prefer_kr_shelf'] = self.prefer_kr_shelf_checkbox.isChecked()
         prefs['prefer_kr_fav'] = self.prefer_kr_fav_checkbox.isChecked()
+        prefs['local_db_copy'] = self.local_db_copy_checkbox.isChecked()
 
 
 
@@ -3,10 +3,13 @@ __copyright__ = '2024, Anareaty <reatymain@gmail.com>'
 __docformat__ = 'restructuredtext en'
 
 
-import json, time, re, os, errno, operator
-from calibre_plugins.pocketbook_collections.slpp import slpp as lua
+import json, time, re, os, io, errno, operator, itertools, functools, shutil, tempfile, hashlib
+from calibre_plugins.pocketbook_collections.slpp import slpp as lua, PartialTable, ParseError
 import sqlite3 as sqlite
-from contextlib import closing
+try:
+    from urllib.request import pathname2url
+except ImportError:
+    from urllib import pathname2url
 from calibre.library import db as calibre_db
 from calibre_plugins.pocketbook_collections.config import prefs
 import xml.etree.ElementTree as ET
@@ -19,11 +22,9 @@ def set_globals(data):
     global calibreAPI
     global device_DB_path
     global device_main_storage
-    global device_metadata_main
     global device_card
-    global device_metadata_card
+    global device_books
     global db_row_factory 
-    global profile_ID
     global storage_prefix_main
     global storage_prefix_card
 
@@ -31,26 +32,28 @@ def set_globals(data):
     calibreAPI = current_db.new_api
     device_DB_path = data["device_DB_path"]
     device_main_storage = data["device_storages"]["main"]
-    device_metadata_path_main = device_main_storage + "metadata.calibre"
-    with open(device_metadata_path_main, "r") as file_main:
-        device_metadata_main = json.load(file_main)
-
-    
-
 
     device_card = None
     if data["device_storages"].get("card"):
         device_card = data["device_storages"]["card"]
-        device_metadata_path_card = device_card + "metadata.calibre"
-        with open(device_metadata_path_card, "r") as file_card:
-            device_metadata_card = json.load(file_card)
+
+    # Index books on device by Calibre ID once, so every book could be found without scanning the metadata lists.
+    # Normally the index is built by GUI from the device book lists it already has, and metadata.calibre is only read if it was not passed.
+    device_books = data.get("device_books")
+    if not device_books:
+        device_books = {}
+        device_metadata_path_main = device_main_storage + "metadata.calibre"
+        index_device_books(read_device_metadata(device_metadata_path_main), "main")
+
+        if device_card:
+            device_metadata_path_card = device_card + "metadata.calibre"
+            index_device_books(read_device_metadata(device_metadata_path_card), "card")
 
     storage_prefix_main = "/mnt/ext1"
     storage_prefix_card = None
     if device_card:
         storage_prefix_card = "/mnt/ext2"
 
-    profile_ID = str(get_current_profile_ID())
     db_row_factory = lambda cursor, row: {col[0]: row[i] for i, col in enumerate(cursor.description)}
 
 
@@ -169,12 +172,44 @@ def set_globals(data):
     if sync_shelf_kr and prefs['prefer_kr_shelf']:
         pref_shelf_kr = True
 
+    # Index of KOReader sidecars on device, it is built when the first sidecar is needed
+    global kr_sidecars
+    kr_sidecars = None
+
+    global kr_collections
+    kr_collections = None
+
+    # Synced Calibre fields of the books on device, they are read by get_calibre_fields. Until then get_calibre_field asks Calibre for every book.
+    global calibre_fields
+    calibre_fields = {}
+
     
 
 
 
 
 
+def device_job(job):
+    # Connections to device databases are closed when the job ends, even if it fails
+    @functools.wraps(job)
+    def run_device_job(data):
+        global device_writes
+        global explorer_db_copy
+        device_writes = {"written": 0, "skipped": 0}
+        explorer_db_copy = None
+        try:
+            return job(data)
+        finally:
+            device_connections.close_all()
+            # The local copy of the device database is removed after the connections to it are closed
+            remove_explorer_db_copy()
+            if device_writes["written"] or device_writes["skipped"]:
+                print("PB-COLLECTIONS: Bytes written to device files: " + str(device_writes["written"]) + ", not written because unchanged: " + str(device_writes["skipped"]))
+    return run_device_job
+
+
+
+@device_job
 def send_all(data):
     try:
         set_globals(data)
@@ -184,12 +219,13 @@ def send_all(data):
     if sync_all:
         if sync_db:
             db = prepare_explorer_db()
+        calibre_book_IDs = get_device_calibre_book_IDs()
+        get_calibre_fields(calibre_book_IDs, ["shelf_lookup_name", "read_lookup_name", "fav_lookup_name", "rating_lookup_name", "review_lookup_name"])
         if sync_shelf:
-            create_shelfs_dicts(db)
+            create_shelfs_dicts(db, calibre_book_IDs)
         if sync_kr_collections:
             get_kr_collections()
             create_missing_kr_collections()
-        calibre_book_IDs = calibreAPI.all_book_ids()
 
         for calibre_book_ID in calibre_book_IDs:
             book = SyncBook(calibre_book_ID)
@@ -201,7 +237,7 @@ def send_all(data):
                     if sync_statuses:
                         book.send_statuses(db)
                 if sync_kr:
-                    book.get_kr_metadata()
+                    book.get_kr_metadata(["summary"])
                 if sync_shelf_kr:
                     book.send_book_collections_kr()
                 if sync_read_kr:
@@ -212,9 +248,10 @@ def send_all(data):
                     book.send_rating_kr()
                 if sync_review:
                     book.send_review_kr()
+                book.flush_kr_sidecar()
 
         if sync_db:
-            db.close()
+            close_explorer_db(db)
         if kr_collections:
             update_kr_collections(kr_collections)
     done_msg = "Sending metadata finished"
@@ -222,6 +259,7 @@ def send_all(data):
 
 
 
+@device_job
 def send_collections(data):
     try:
         set_globals(data)
@@ -230,11 +268,12 @@ def send_collections(data):
 
     if sync_shelf:
         db = prepare_explorer_db()
-        create_shelfs_dicts(db)
+        calibre_book_IDs = get_device_calibre_book_IDs()
+        get_calibre_fields(calibre_book_IDs, ["shelf_lookup_name"])
+        create_shelfs_dicts(db, calibre_book_IDs)
         if sync_kr_collections:
             get_kr_collections()
             create_missing_kr_collections()
-        calibre_book_IDs = calibreAPI.all_book_ids()
 
         for calibre_book_ID in calibre_book_IDs:
             book = SyncBook(calibre_book_ID)
@@ -243,10 +282,9 @@ def send_collections(data):
                 if book.book_row:
                     book.send_book_collections(db)
                 if sync_shelf_kr:
-                    book.get_kr_metadata()
                     book.send_book_collections_kr()
 
-        db.close()
+        close_explorer_db(db)
         if sync_shelf_kr:
             update_kr_collections(kr_collections)
     done_msg = "Sending collections finished"
@@ -259,6 +297,7 @@ def send_collections(data):
 
 
 
+@device_job
 def send_read(data):
     try:
         set_globals(data)
@@ -267,7 +306,8 @@ def send_read(data):
 
     if sync_read:
         db = prepare_explorer_db()
-        calibre_book_IDs = calibreAPI.all_book_ids()
+        calibre_book_IDs = get_device_calibre_book_IDs()
+        get_calibre_fields(calibre_book_IDs, ["read_lookup_name"])
 
         for calibre_book_ID in calibre_book_IDs:
             book = SyncBook(calibre_book_ID)
@@ -277,10 +317,11 @@ def send_read(data):
                     book.send_read_status(db)
 
                 if sync_read_kr:
-                    book.get_kr_metadata()
+                    book.get_kr_metadata(["summary"])
                     book.send_read_kr()
+                    book.flush_kr_sidecar()
 
-        db.close()
+        close_explorer_db(db)
     done_msg = "Sending read finished"
     return None, done_msg
 
@@ -289,6 +330,7 @@ def send_read(data):
 
 
 
+@device_job
 def send_favorite(data):
     try:
         set_globals(data)
@@ -299,7 +341,8 @@ def send_favorite(data):
         db = prepare_explorer_db()
         if sync_fav_kr:
             get_kr_collections()
-        calibre_book_IDs = calibreAPI.all_book_ids()
+        calibre_book_IDs = get_device_calibre_book_IDs()
+        get_calibre_fields(calibre_book_IDs, ["fav_lookup_name"])
 
         for calibre_book_ID in calibre_book_IDs:
             book = SyncBook(calibre_book_ID)
@@ -310,7 +353,7 @@ def send_favorite(data):
                 if sync_fav_kr:
                     book.send_fav_kr()
 
-        db.close()
+        close_explorer_db(db)
         if sync_fav_kr:
             update_kr_collections(kr_collections)
     done_msg = "Sending favorite finished"
@@ -321,6 +364,7 @@ def send_favorite(data):
 
 
 
+@device_job
 def send_ratings(data):
     try:
         set_globals(data)
@@ -328,13 +372,15 @@ def send_ratings(data):
         return "error", "Can not reach device metadata, it is probably still updating. Try again later."
     if sync_rating:
         #prepare_explorer_db()
-        calibre_book_IDs = calibreAPI.all_book_ids()
+        calibre_book_IDs = get_device_calibre_book_IDs()
+        get_calibre_fields(calibre_book_IDs, ["rating_lookup_name"])
 
         for calibre_book_ID in calibre_book_IDs:
             book = SyncBook(calibre_book_ID)
             if book.device_book_metadata:
-                book.get_kr_metadata()
+                book.get_kr_metadata(["summary"])
                 book.send_rating_kr()
+                book.flush_kr_sidecar()
     done_msg = "Sending ratings finished"
     return None, done_msg
 
@@ -342,6 +388,7 @@ def send_ratings(data):
 
 
 
+@device_job
 def send_reviews(data):
     try:
         set_globals(data)
@@ -349,13 +396,15 @@ def send_reviews(data):
         return "error", "Can not reach device metadata, it is probably still updating. Try again later."
     if sync_review:
         #prepare_explorer_db()
-        calibre_book_IDs = calibreAPI.all_book_ids()
+        calibre_book_IDs = get_device_calibre_book_IDs()
+        get_calibre_fields(calibre_book_IDs, ["review_lookup_name"])
 
         for calibre_book_ID in calibre_book_IDs:
             book = SyncBook(calibre_book_ID)
             if book.device_book_metadata:
-                book.get_kr_metadata()
+                book.get_kr_metadata(["summary"])
                 book.send_review_kr()
+                book.flush_kr_sidecar()
     done_msg = "Sending reviews finished"
     return None, done_msg
 
@@ -363,6 +412,7 @@ def send_reviews(data):
 
 
 
+@device_job
 def load_all(data):
     try:
         set_globals(data)
@@ -381,12 +431,13 @@ def load_all(data):
 
     if sync_all:
         if sync_db:
-            db = prepare_explorer_db()
+            db = prepare_explorer_db(read_only=True)
         if sync_shelf:
             create_shelfs_dicts(db)
         if sync_kr_collections:
             get_kr_collections()
-        calibre_book_IDs = calibreAPI.all_book_ids()
+        calibre_book_IDs = get_device_calibre_book_IDs()
+        get_calibre_fields(calibre_book_IDs, ["shelf_lookup_name", "read_lookup_name", "fav_lookup_name", "rating_lookup_name", "review_lookup_name"])
 
         for calibre_book_ID in calibre_book_IDs:
             book = SyncBook(calibre_book_ID)
@@ -399,7 +450,7 @@ def load_all(data):
                 if sync_db:
                     book.process_db(db)
                 if sync_kr:
-                    book.get_kr_metadata()
+                    book.get_kr_metadata(["summary"])
                 if book.book_row:
                     if sync_shelf:
                         if pref_shelf_kr:
@@ -413,7 +464,7 @@ def load_all(data):
                         if to_load_statuses["fav"]:
                             to_load_fav = to_load_statuses["fav"]
                 if sync_read_kr:
-                    book.get_kr_metadata()
+                    book.get_kr_metadata(["summary"])
                     to_load_read_kr = book.load_read_kr()
                     if to_load_read_kr:
                         to_load_read = to_load_read_kr
@@ -439,7 +490,7 @@ def load_all(data):
                   
 
         if sync_db:
-            db.close()
+            close_explorer_db(db)
     done_msg = "Sending metadata finished"
     return to_load, done_msg
 
@@ -459,6 +510,7 @@ def load_all(data):
 
 
 
+@device_job
 def load_collections(data):
     try:
         set_globals(data)
@@ -472,12 +524,13 @@ def load_collections(data):
 
     if sync_shelf:
         if not pref_shelf_kr:
-            db = prepare_explorer_db()
+            db = prepare_explorer_db(read_only=True)
             create_shelfs_dicts(db)
         else:
             get_kr_collections()
         
-        calibre_book_IDs = calibreAPI.all_book_ids()
+        calibre_book_IDs = get_device_calibre_book_IDs()
+        get_calibre_fields(calibre_book_IDs, ["shelf_lookup_name"])
 
         for calibre_book_ID in calibre_book_IDs:
             book = SyncBook(calibre_book_ID)
@@ -492,8 +545,8 @@ def load_collections(data):
                 if to_load_shelf:
                     to_load["shelf"][calibre_book_ID] = to_load_shelf
                     to_load["books_to_refresh"].append(calibre_book_ID)
-        if not pref_fav_kr:
-            db.close()
+        if not pref_shelf_kr:
+            close_explorer_db(db)
     done_msg = "Loaded favorite"
     return to_load, done_msg
 
@@ -502,6 +555,7 @@ def load_collections(data):
 
 
 
+@device_job
 def load_read(data):
     try:
         set_globals(data)
@@ -514,8 +568,9 @@ def load_read(data):
     }
     
     if sync_read:
-        db = prepare_explorer_db()
-        calibre_book_IDs = calibreAPI.all_book_ids()
+        db = prepare_explorer_db(read_only=True)
+        calibre_book_IDs = get_device_calibre_book_IDs()
+        get_calibre_fields(calibre_book_IDs, ["read_lookup_name"])
 
         for calibre_book_ID in calibre_book_IDs:
             book = SyncBook(calibre_book_ID)
@@ -525,7 +580,7 @@ def load_read(data):
                 if book.book_row:
                     to_load_read = book.load_read_status(db)
                 if sync_read_kr:
-                    book.get_kr_metadata()
+                    book.get_kr_metadata(["summary"])
                     to_load_read_kr = book.load_read_kr()
                     if to_load_read_kr:
                         to_load_read = to_load_read_kr
@@ -533,7 +588,7 @@ def load_read(data):
                     to_load["read"][calibre_book_ID] = to_load_read["status"]
                     to_load["books_to_refresh"].append(calibre_book_ID)
         
-        db.close()
+        close_explorer_db(db)
     done_msg = "Loaded read"
     return to_load, done_msg
 
@@ -544,6 +599,7 @@ def load_read(data):
 
 
 
+@device_job
 def load_favorite(data):
     try:
         set_globals(data)
@@ -557,10 +613,11 @@ def load_favorite(data):
     
     if sync_fav:
         if not pref_fav_kr:
-            db = prepare_explorer_db()
+            db = prepare_explorer_db(read_only=True)
         else:
             get_kr_collections()
-        calibre_book_IDs = calibreAPI.all_book_ids()
+        calibre_book_IDs = get_device_calibre_book_IDs()
+        get_calibre_fields(calibre_book_IDs, ["fav_lookup_name"])
 
         for calibre_book_ID in calibre_book_IDs:
             book = SyncBook(calibre_book_ID)
@@ -577,7 +634,7 @@ def load_favorite(data):
                     to_load["books_to_refresh"].append(calibre_book_ID)
         
         if not pref_fav_kr:
-            db.close()
+            close_explorer_db(db)
     done_msg = "Loaded favorite"
     return to_load, done_msg
 
@@ -592,6 +649,7 @@ def load_favorite(data):
 
 
 
+@device_job
 def load_reviews(data):
     try:
         set_globals(data)
@@ -604,13 +662,14 @@ def load_reviews(data):
     }
 
     if sync_review:
-        calibre_book_IDs = calibreAPI.all_book_ids()
+        calibre_book_IDs = get_device_calibre_book_IDs()
+        get_calibre_fields(calibre_book_IDs, ["review_lookup_name"])
 
         for calibre_book_ID in calibre_book_IDs:
             book = SyncBook(calibre_book_ID)
             if book.device_book_metadata:
                 to_load_review = None
-                book.get_kr_metadata()
+                book.get_kr_metadata(["summary"])
                 to_load_review = book.load_review_kr()
                 if to_load_review:
                     to_load["reviews"][calibre_book_ID] = to_load_review
@@ -624,6 +683,7 @@ def load_reviews(data):
 
 
 
+@device_job
 def load_ratings(data):
     set_globals(data)
 
@@ -633,13 +693,14 @@ def load_ratings(data):
     }
 
     if sync_rating:
-        calibre_book_IDs = calibreAPI.all_book_ids()
+        calibre_book_IDs = get_device_calibre_book_IDs()
+        get_calibre_fields(calibre_book_IDs, ["rating_lookup_name"])
 
         for calibre_book_ID in calibre_book_IDs:
             book = SyncBook(calibre_book_ID)
             if book.device_book_metadata:
                 to_load_rating = None
-                book.get_kr_metadata()
+                book.get_kr_metadata(["summary"])
                 to_load_rating = book.load_rating_kr()
                 if to_load_rating:
                     to_load["ratings"][calibre_book_ID] = to_load_rating
@@ -655,6 +716,7 @@ def load_ratings(data):
 
 
 
+@device_job
 def sync_position(data):
     set_globals(data)
 
@@ -668,7 +730,8 @@ def sync_position(data):
         if sync_pos_cr:
             get_cr3hist_path()
 
-        calibre_book_IDs = calibreAPI.all_book_ids()
+        calibre_book_IDs = get_device_calibre_book_IDs()
+        get_calibre_fields(calibre_book_IDs, ["position_lookup_name"])
 
         for calibre_book_ID in calibre_book_IDs:
             book = SyncBook(calibre_book_ID)
@@ -676,12 +739,14 @@ def sync_position(data):
                 positions = {}
                 if sync_pos_pb:
                     book.process_db(db)
-                    to_load_position_pb = book.pb_sync_position(db)
-                    if to_load_position_pb:
-                        positions["pb"] = to_load_position_pb
+                    if book.book_row:
+                        to_load_position_pb = book.pb_sync_position(db)
+                        if to_load_position_pb:
+                            positions["pb"] = to_load_position_pb
                 if sync_pos_kr:
-                    book.get_kr_metadata()
+                    book.get_kr_metadata(["last_xpointer"])
                     to_load_position_kr = book.kr_sync_position()
+                    book.flush_kr_sidecar()
                     if to_load_position_kr:
                         positions["kr"] = to_load_position_kr
                 if sync_pos_cr:
@@ -693,6 +758,8 @@ def sync_position(data):
                 if len(positions) > 0:
                     to_load["position"][calibre_book_ID] = str(positions)
                     to_load["books_to_refresh"].append(calibre_book_ID)
+        if sync_pos_pb:
+            close_explorer_db(db)
     done_msg = "Synced"
     return to_load, done_msg      
 
@@ -702,6 +769,7 @@ def sync_position(data):
 
 
 
+@device_job
 def force_position(data):
     set_globals(data)
 
@@ -711,19 +779,24 @@ def force_position(data):
         if sync_pos_cr:
             get_cr3hist_path()
 
-        calibre_book_IDs = calibreAPI.all_book_ids()
+        calibre_book_IDs = get_device_calibre_book_IDs()
+        get_calibre_fields(calibre_book_IDs, ["position_lookup_name"])
 
         for calibre_book_ID in calibre_book_IDs:
             book = SyncBook(calibre_book_ID)
             if book.device_book_metadata:
                 if sync_pos_pb:
                     book.process_db(db)
-                    book.pb_force_position(db)
+                    if book.book_row:
+                        book.pb_force_position(db)
                 if sync_pos_kr:
-                    book.get_kr_metadata()
+                    book.get_kr_metadata(["last_xpointer"])
                     book.kr_force_position()
+                    book.flush_kr_sidecar()
                 if sync_pos_cr:
                     book.cr_force_position()
+        if sync_pos_pb:
+            close_explorer_db(db)
     
     done_msg = "Synced"
     return None, done_msg      
@@ -734,6 +807,7 @@ def force_position(data):
 
 
 
+@device_job
 def extract_annotations(data):
     try:
         set_globals(data)
@@ -750,7 +824,8 @@ def extract_annotations(data):
             db = prepare_books_db()
         if load_an_cr:
             get_cr3hist_path()
-        calibre_book_IDs = calibreAPI.all_book_ids()
+        calibre_book_IDs = get_device_calibre_book_IDs()
+        get_calibre_fields(calibre_book_IDs, ["an_lookup_name"])
 
         for calibre_book_ID in calibre_book_IDs:
             book = SyncBook(calibre_book_ID)
@@ -773,6 +848,9 @@ def extract_annotations(data):
                 to_load["annotations"][calibre_book_ID] = book.annotations_html
                 to_load["books_to_refresh"].append(calibre_book_ID)
 
+        if load_an_pb:
+            device_connections.close("books")
+
     done_msg = "Loading annotations finished"
     return to_load, done_msg              
                 
@@ -783,44 +861,395 @@ def extract_annotations(data):
 
 
 
-def prepare_explorer_db():
-    db = sqlite.connect(device_DB_path)
-    db.row_factory = db_row_factory
-    clean_database(db)
-    #set_storage_prefixes(db)
-    get_books_missing_author_ids(db)
+def prepare_explorer_db(read_only=False):
+    global profile_ID
+    global explorer_writer
+    global explorer_db_copy
+    global collection_sync
+    global clean_fingerprint
+    remove_explorer_db_copy()
+    clean_fingerprint = None
+
+    # Jobs that only load metadata from device open the database in read only mode, and do not clean or fix it
+    if read_only:
+        db = device_connections.open("explorer", device_DB_path, read_only=True)
+    else:
+        db_path = device_DB_path
+        if prefs['local_db_copy']:
+            explorer_db_copy = copy_explorer_db()
+            if explorer_db_copy:
+                db_path = explorer_db_copy["local_path"]
+        db = device_connections.open("explorer", db_path)
+
+    profile_ID = str(get_current_profile_ID(db))
+    explorer_writer = ExplorerWriter(db)
+    collection_sync = CollectionSync(db)
+    if not read_only:
+        clean_database(db)
+        #set_storage_prefixes(db)
+    get_explorer_books(db)
+    if not read_only:
+        fix_missing_authors(db)
+    get_books_settings(db)
     return db
 
 
 
 
+def close_explorer_db(db):
+    rows_written = explorer_writer.flush()
+    # Collections sync fills temporary tables, which total_changes also counts, so the changes are counted before it and its own rows are added
+    changes = db.total_changes
+    synced_rows = collection_sync.apply()
+    rows_written += synced_rows
+    changes += synced_rows
+    print("PB-COLLECTIONS: Rows written to device database: " + str(rows_written))
+    device_connections.close("explorer")
+
+    written_back = True
+    if explorer_db_copy and changes > 0:
+        written_back = write_back_explorer_db()
+
+    # The database is marked as clean only when the cleaning has reached the database on device
+    if clean_fingerprint != None and written_back:
+        save_clean_fingerprint(clean_fingerprint)
+
+
+
+# Reading and writing the database on device storage is slow, so the whole job may run against a local copy, which is written back once at the end
+
+def copy_explorer_db():
+    # If the reader left a journal, the database may have unfinished changes, so we work with it on device
+    for journal_suffix in ("-journal", "-wal"):
+        if os.path.exists(device_DB_path + journal_suffix):
+            return None
+
+    device_stat = get_file_stat(device_DB_path)
+    local_dir = tempfile.mkdtemp(prefix="pocketbook_collections_")
+    local_path = os.path.join(local_dir, os.path.basename(device_DB_path))
+    shutil.copyfile(device_DB_path, local_path)
+
+    # If the database was changed while copying, the copy may be broken
+    if get_file_stat(device_DB_path) != device_stat:
+        shutil.rmtree(local_dir, ignore_errors=True)
+        return None
+
+    return {"local_dir": local_dir, "local_path": local_path, "device_stat": device_stat}
+
+
+
+def remove_explorer_db_copy():
+    global explorer_db_copy
+    if explorer_db_copy:
+        shutil.rmtree(explorer_db_copy["local_dir"], ignore_errors=True)
+    explorer_db_copy = None
+
+
+
+def write_back_explorer_db():
+    local_path = explorer_db_copy["local_path"]
+
+    # Never overwrite the changes made by the reader while the job was running
+    if get_file_stat(device_DB_path) != explorer_db_copy["device_stat"]:
+        print("PB-COLLECTIONS: Device database was changed during the job, changes are not written")
+        return False
+
+    # Copy the database to a temporary file near the original and replace the original only if the copy is verified
+    temp_path = device_DB_path + ".tmp"
+    shutil.copyfile(local_path, temp_path)
+    with open(temp_path, "rb") as file:
+        os.fsync(file.fileno())
+
+    if get_file_hash(temp_path) != get_file_hash(local_path) or get_file_stat(device_DB_path) != explorer_db_copy["device_stat"]:
+        os.remove(temp_path)
+        print("PB-COLLECTIONS: Can not write device database, changes are not written")
+        return False
+
+    replace_file(temp_path, device_DB_path)
+    return True
+
+
+
+def get_file_stat(path):
+    file_stat = os.stat(path)
+    return (file_stat.st_size, file_stat.st_mtime)
+
+
+
+def get_file_hash(path):
+    file_hash = hashlib.sha1()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1048576), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+
+def replace_file(source_path, target_path):
+    try:
+        os.replace(source_path, target_path)  # Python>3.3
+    except AttributeError:
+        if os.path.exists(target_path):
+            os.remove(target_path)
+        os.rename(source_path, target_path)
+
+
+
+def write_device_file(path, write_content):
+    # Most syncs write the same content the files already have, so the content is hashed first and the file is written only if it is changed.
+    # write_content is called with a write function and gives the content by chunks. For a changed file it is called again to write a temporary file near the original, which then replaces it.
+    def to_bytes(chunk):
+        if not isinstance(chunk, bytes):
+            chunk = chunk.encode("utf-8")
+        return chunk
+
+    content_hash = hashlib.sha1()
+    content_size = [0]
+    def hash_chunk(chunk):
+        chunk = to_bytes(chunk)
+        content_hash.update(chunk)
+        content_size[0] += len(chunk)
+    write_content(hash_chunk)
+
+    if os.path.isfile(path) and os.path.getsize(path) == content_size[0] and get_file_hash(path) == content_hash.hexdigest():
+        device_writes["skipped"] += content_size[0]
+        return False
+
+    folder, name = os.path.split(path)
+    fd, temp_path = tempfile.mkstemp(prefix="." + name + ".", suffix=".tmp", dir=folder)
+    try:
+        with os.fdopen(fd, "wb") as file:
+            write_content(lambda chunk: file.write(to_bytes(chunk)))
+            file.flush()
+            os.fsync(file.fileno())
+        replace_file(temp_path, path)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    device_writes["written"] += content_size[0]
+    return True
+
+
+
+# All per book statements use fixed SQL with parameters, so SQLite compiles each of them once and takes it from the statement cache afterwards
+explorer_queries = {
+    "select_book_shelfs": "SELECT bookshelfid, is_deleted, ts FROM bookshelfs_books WHERE bookid = ?",
+    "select_profile_ID": "SELECT id FROM profiles WHERE name = ?",
+    "select_books_settings": "SELECT bookid, completed, favorite, position, position_ts FROM books_settings WHERE profileid = ?",
+    "insert_shelf": "INSERT INTO bookshelfs(name, is_deleted, ts) VALUES(?, 0, ?)",
+    "update_authors": "UPDATE books_impl SET title = COALESCE(?, title), author = ?, firstauthor = ?, first_author_letter = ? WHERE id = ?",
+    "update_read": "UPDATE books_settings SET completed = ?, completed_ts = ? WHERE bookid = ? AND profileid = ?",
+    "insert_read": "INSERT INTO books_settings(bookid, profileid, completed, completed_ts) VALUES(?, ?, ?, ?)",
+    "update_fav": "UPDATE books_settings SET favorite = ?, favorite_ts = ? WHERE bookid = ? AND profileid = ?",
+    "insert_fav": "INSERT INTO books_settings(bookid, profileid, favorite, favorite_ts) VALUES(?, ?, ?, ?)",
+    "update_statuses": "UPDATE books_settings SET completed = ?, completed_ts = ?, favorite = ?, favorite_ts = ? WHERE bookid = ? AND profileid = ?",
+    "insert_statuses": "INSERT INTO books_settings(bookid, profileid, completed, completed_ts, favorite, favorite_ts) VALUES(?, ?, ?, ?, ?, ?)",
+    "update_position": "UPDATE books_settings SET position = ?, position_ts = ? WHERE bookid = ? AND profileid = ?",
+    "insert_position": "INSERT INTO books_settings(bookid, profileid, position, position_ts) VALUES(?, ?, ?, ?)"
+}
+
+
+
+class ExplorerWriter():
+    # Every commit is slow on device storage, so changes to the reader database are queued and written together in one transaction.
+    # Consecutive statements with the same query are run by one executemany, and the order of statements is kept.
+
+    def __init__(self, db, queue_limit=5000):
+        self.db = db
+        self.queue = []
+        self.queue_limit = queue_limit
+        self.rows_written = 0
+
+    def execute(self, query, params):
+        self.queue.append((query, params))
+        if len(self.queue) >= self.queue_limit:
+            self.flush()
+
+    def flush(self):
+        if len(self.queue) > 0:
+            cursor = self.db.cursor()
+            for query, statements in itertools.groupby(self.queue, key=operator.itemgetter(0)):
+                cursor.executemany(query, [params for query, params in statements])
+                if cursor.rowcount > 0:
+                    self.rows_written += cursor.rowcount
+            self.db.commit()
+            self.queue = []
+        return self.rows_written
+
+
+
+class CollectionSync():
+    # Collections of all books are collected first and then the differences with bookshelfs_books are applied by a few statements for the whole library.
+    # Every synced book is written with its timestamp to sync_books, and the collections it must be in are written to sync_shelfs.
+
+    def __init__(self, db):
+        self.db = db
+        self.books = []
+        self.shelfs = []
+
+    def add_book(self, book_ID, ts, bookshelf_IDs):
+        self.books.append((book_ID, ts))
+        for bookshelf_ID in bookshelf_IDs:
+            self.shelfs.append((book_ID, bookshelf_ID))
+
+    def apply(self):
+        rows_written = 0
+        if len(self.books) > 0:
+            cursor = self.db.cursor()
+            cursor.execute("CREATE TEMP TABLE IF NOT EXISTS sync_books(bookid INTEGER PRIMARY KEY, ts INTEGER)")
+            cursor.execute("CREATE TEMP TABLE IF NOT EXISTS sync_shelfs(bookid INTEGER, bookshelfid INTEGER, PRIMARY KEY(bookid, bookshelfid))")
+            cursor.execute("DELETE FROM temp.sync_books")
+            cursor.execute("DELETE FROM temp.sync_shelfs")
+            cursor.executemany("INSERT OR IGNORE INTO temp.sync_books(bookid, ts) VALUES(?, ?)", self.books)
+            cursor.executemany("INSERT OR IGNORE INTO temp.sync_shelfs(bookid, bookshelfid) VALUES(?, ?)", self.shelfs)
+
+            for query in [
+                # If the book is in collection, but marked as deleted, mark it as not deleted
+                """UPDATE bookshelfs_books SET is_deleted = 0, ts = (SELECT ts FROM temp.sync_books WHERE sync_books.bookid = bookshelfs_books.bookid)
+                    WHERE is_deleted != 0
+                    AND EXISTS (SELECT 1 FROM temp.sync_shelfs WHERE sync_shelfs.bookid = bookshelfs_books.bookid AND sync_shelfs.bookshelfid = bookshelfs_books.bookshelfid)""",
+                # If collection is not in Calibre and not marked as deleted in reader, mark it as deleted
+                """UPDATE bookshelfs_books SET is_deleted = 1, ts = (SELECT ts FROM temp.sync_books WHERE sync_books.bookid = bookshelfs_books.bookid)
+                    WHERE (is_deleted IS NULL OR is_deleted != 1)
+                    AND bookid IN (SELECT bookid FROM temp.sync_books)
+                    AND NOT EXISTS (SELECT 1 FROM temp.sync_shelfs WHERE sync_shelfs.bookid = bookshelfs_books.bookid AND sync_shelfs.bookshelfid = bookshelfs_books.bookshelfid)""",
+                # If the book is not in collection, add it to collection
+                """INSERT INTO bookshelfs_books(bookshelfid, bookid, ts, is_deleted)
+                    SELECT sync_shelfs.bookshelfid, sync_shelfs.bookid, sync_books.ts, 0 FROM temp.sync_shelfs JOIN temp.sync_books ON sync_books.bookid = sync_shelfs.bookid
+                    WHERE NOT EXISTS (SELECT 1 FROM bookshelfs_books WHERE bookshelfs_books.bookid = sync_shelfs.bookid AND bookshelfs_books.bookshelfid = sync_shelfs.bookshelfid)"""
+            ]:
+                cursor.execute(query)
+                if cursor.rowcount > 0:
+                    rows_written += cursor.rowcount
+
+            self.db.commit()
+            self.books = []
+            self.shelfs = []
+        return rows_written
+
+
+
 def prepare_books_db():
     books_db_path = os.path.join(device_main_storage, "system", "config", "books.db")
-    db = sqlite.connect(books_db_path)
-    db.row_factory = lambda cursor, row: {col[0]: row[i] for i, col in enumerate(cursor.description)}
-    return db
+    return device_connections.open("books", books_db_path, read_only=True)
+
+
+
+class DeviceConnections():
+    # Every device database is opened once per job and the same connection is used by all steps of the job.
+    # Opening a database and parsing its schema is slow on device storage, so the connections are tuned to read as little from device as possible.
+
+    pragmas = [
+        "PRAGMA cache_size = -16384",
+        "PRAGMA temp_store = MEMORY",
+        "PRAGMA mmap_size = 268435456"
+    ]
+
+    def __init__(self, cached_statements=256):
+        self.connections = {}
+        self.cached_statements = cached_statements
+
+    def open(self, name, path, read_only=False):
+        if name not in self.connections:
+            if read_only:
+                db = connect_read_only(path, cached_statements=self.cached_statements)
+            else:
+                db = sqlite.connect(path, cached_statements=self.cached_statements)
+            for pragma in self.pragmas:
+                db.execute(pragma)
+            db.row_factory = db_row_factory
+            self.connections[name] = db
+        return self.connections[name]
+
+    def close(self, name):
+        db = self.connections.pop(name, None)
+        if db:
+            db.close()
+
+    def close_all(self):
+        for name in list(self.connections):
+            self.close(name)
+
+
+
+device_connections = DeviceConnections()
+
+
+
+def connect_read_only(path, cached_statements=100):
+    try:
+        return sqlite.connect("file:" + pathname2url(os.path.abspath(path)) + "?mode=ro", uri=True, cached_statements=cached_statements)  # Python>3.4
+    except TypeError:
+        return sqlite.connect(path, cached_statements=cached_statements)
 
 
 def clean_database(db):
+    global clean_fingerprint
     cursor = db.cursor()
-    cursor.execute("DELETE FROM books_settings WHERE bookid IN (SELECT id FROM books_impl WHERE id NOT IN (SELECT book_id FROM files))")
-    cursor.execute("DELETE FROM booktogenre WHERE bookid IN (SELECT id FROM books_impl WHERE id NOT IN (SELECT book_id FROM files))")
-    cursor.execute("DELETE FROM social WHERE bookid IN (SELECT id FROM books_impl WHERE id NOT IN (SELECT book_id FROM files))")
-    cursor.execute("DELETE FROM books_impl WHERE id NOT IN (SELECT book_id FROM files)")
-    cursor.execute("DELETE FROM books_fast_hashes WHERE book_id NOT IN (SELECT book_id FROM files)")
-    db.commit()
 
+    # Books only become orphaned when files are deleted, so if the files table was not changed since the last cleaning, there is nothing to clean
+    files_row = cursor.execute("SELECT COUNT(*) AS files_count, MAX(book_id) AS max_book_id FROM files").fetchone()
+    files_fingerprint = [files_row["files_count"], files_row["max_book_id"]]
+    if read_clean_fingerprint() == files_fingerprint:
+        return 0
+
+    # Find orphaned books once and delete them from every table
+    file_book_IDs = set(row["book_id"] for row in cursor.execute("SELECT book_id FROM files").fetchall())
+    orphan_book_IDs = [row["id"] for row in cursor.execute("SELECT id FROM books_impl").fetchall() if row["id"] not in file_book_IDs]
+    orphan_hash_IDs = [row["book_id"] for row in cursor.execute("SELECT DISTINCT book_id FROM books_fast_hashes").fetchall() if row["book_id"] not in file_book_IDs]
+
+    rows_removed = 0
+    for table, column, IDs in [
+        ("books_settings", "bookid", orphan_book_IDs),
+        ("booktogenre", "bookid", orphan_book_IDs),
+        ("social", "bookid", orphan_book_IDs),
+        ("books_impl", "id", orphan_book_IDs),
+        ("books_fast_hashes", "book_id", orphan_hash_IDs)
+    ]:
+        for i in range(0, len(IDs), 500):
+            IDs_chunk = IDs[i:i + 500]
+            cursor.execute("DELETE FROM " + table + " WHERE " + column + " IN (" + ", ".join("?" * len(IDs_chunk)) + ")", IDs_chunk)
+            rows_removed += cursor.rowcount
+
+    if rows_removed > 0:
+        db.commit()
+        print("PB-COLLECTIONS: Orphaned rows removed from device database: " + str(rows_removed))
+
+    # The fingerprint is saved by close_explorer_db, after the changes are written to device
+    clean_fingerprint = files_fingerprint
+    return rows_removed
+
+
+
+def get_clean_fingerprint_path():
+    # The fingerprint of the last cleaning is kept on device near the database it describes
+    return os.path.join(os.path.dirname(device_DB_path), "pocketbook_collections_clean.json")
 
-def get_current_profile_ID():
+
+
+def read_clean_fingerprint():
+    try:
+        with io.open(get_clean_fingerprint_path(), "r", encoding="utf-8") as file:
+            return json.load(file).get("files_fingerprint")
+    except (IOError, OSError, ValueError, AttributeError):
+        return None
+
+
+
+def save_clean_fingerprint(files_fingerprint):
+    content = json.dumps({"files_fingerprint": files_fingerprint})
+    write_device_file(get_clean_fingerprint_path(), lambda write: write(content))
+
+
+def get_current_profile_ID(db):
     profileLinkPath = os.path.join(device_main_storage, "system", "profiles", ".current.lnk")
     if os.path.exists(profileLinkPath):
         with open(profileLinkPath,'rb') as file:
             link = str(file.read())
             profileName = re.sub(r".*/", "", link).replace("'", "")
-        with closing(sqlite.connect(device_DB_path)) as db:
-            db.row_factory = lambda cursor, row: {col[0]: row[i] for i, col in enumerate(cursor.description)}
-            cursor = db.cursor()
-            profile_ID = cursor.execute("SELECT id FROM profiles WHERE name = '" + profileName + "'").fetchone()["id"]
+        cursor = db.cursor()
+        profile_ID = cursor.execute(explorer_queries["select_profile_ID"], (profileName,)).fetchone()["id"]
     else:
         profile_ID = 1    
     return profile_ID
@@ -829,8 +1258,177 @@ def get_current_profile_ID():
 def get_books_missing_author_ids(db):
     cursor = db.cursor()
     books_missing_authors = cursor.execute("SELECT id FROM books_impl WHERE author = ''").fetchall()
-    global books_missing_authors_IDs
-    books_missing_authors_IDs = [book["id"] for book in books_missing_authors]
+    return set(book["id"] for book in books_missing_authors)
+
+
+
+def fix_missing_authors(db):
+    # Books that the reader indexed without authors get authors from Calibre. All such books on device are fixed at once before syncing.
+    books_missing_authors_IDs = get_books_missing_author_ids(db)
+    if len(books_missing_authors_IDs) == 0:
+        return
+
+    library_book_IDs = calibreAPI.all_book_ids()
+    books_to_fix = []
+    for calibre_book_ID in sorted(device_books):
+        if calibre_book_ID in library_book_IDs:
+            book = SyncBook(calibre_book_ID)
+            book_folder, book_file = book.book_fullpath.rsplit('/', 1)
+            reader_book_ID = explorer_books.get((book_folder, book_file))
+            if reader_book_ID in books_missing_authors_IDs:
+                books_to_fix.append((calibre_book_ID, reader_book_ID, book_file))
+
+    if len(books_to_fix) == 0:
+        return
+
+    calibre_book_IDs = [calibre_book_ID for calibre_book_ID, reader_book_ID, book_file in books_to_fix]
+    titles = calibreAPI.all_field_for("title", calibre_book_IDs)
+    authors_sort = calibreAPI.all_field_for("author_sort", calibre_book_IDs)
+
+    for calibre_book_ID, reader_book_ID, book_file in books_to_fix:
+        authors = authors_sort.get(calibre_book_ID)
+        if not authors:
+            continue
+        authors_string = authors.replace(",", "").replace(" & ", ", ")
+        author_first = authors.split(" & ")[0].split(",")[0]
+        author_first_letter = author_first[:1]
+
+        # Title is fixed only for pdf books, for other books it is left as is
+        title = None
+        if book_file.rsplit('.', 1)[1] == "pdf":
+            title = titles.get(calibre_book_ID)
+        explorer_writer.execute(explorer_queries["update_authors"], (title, authors_string, author_first, author_first_letter, reader_book_ID))
+
+
+def read_device_metadata(path):
+    # metadata.calibre has the full Calibre metadata for every book, including thumbnails, but we only need application_id, lpath and size.
+    # So instead of loading the whole json, the top level array is read in chunks and decoded one book at a time,
+    # only these fields of the book are kept, and the rest of it is dropped before the next book is decoded.
+    device_metadata = []
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    eof = False
+    started = False
+    read_size = 65536
+
+    with io.open(path, "r", encoding="utf-8") as file:
+        while True:
+            # Skip whitespace, the opening bracket and commas between books
+            while position < len(buffer) and (buffer[position].isspace() or buffer[position] == "," or (buffer[position] == "[" and not started)):
+                if buffer[position] == "[":
+                    started = True
+                position += 1
+
+            if position < len(buffer) and buffer[position] == "]":
+                break
+
+            decoded = False
+            if position < len(buffer):
+                try:
+                    book, end = decoder.raw_decode(buffer, position)
+                    decoded = True
+                except ValueError:
+                    # The book may continue in the next chunk. If the file has ended, it is broken.
+                    if eof:
+                        raise
+            elif eof:
+                break
+
+            if not decoded:
+                # Read at least as much as is already buffered, so a big book is not decoded again for every chunk
+                chunk = file.read(max(read_size, len(buffer) - position))
+                eof = not chunk
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+
+            position = end
+            if isinstance(book, dict) and "application_id" in book and "lpath" in book:
+                device_metadata.append((book["application_id"], book["lpath"], book.get("size")))
+
+    return device_metadata
+
+
+
+def index_device_books(device_metadata, storage):
+    # If the same book is found more than once, the first one is used, and the main storage is indexed before the card
+    for application_id, lpath, size in device_metadata:
+        if application_id != None and application_id not in device_books:
+            device_books[application_id] = (storage, lpath, size)
+
+
+def get_device_calibre_book_IDs():
+    # Only books from metadata.calibre can be synced, so we iterate over them instead of the whole library. Books that were deleted from the library are skipped.
+    library_book_IDs = calibreAPI.all_book_ids()
+    calibre_book_IDs = sorted(calibre_book_ID for calibre_book_ID in device_books if calibre_book_ID in library_book_IDs)
+    return calibre_book_IDs
+
+
+
+def get_calibre_fields(calibre_book_IDs, pref_names):
+    # Read the columns synced by the job for the books on device from Calibre at once, instead of asking Calibre for every field of every book.
+    # pref_names are the prefs with lookup names of the columns the job needs, columns that are not synced are skipped.
+    global calibre_fields
+    calibre_fields = {}
+    lookup_names = ["last_modified"]
+    for sync_field, pref_name in [
+        (sync_shelf, "shelf_lookup_name"),
+        (sync_read, "read_lookup_name"),
+        (sync_fav, "fav_lookup_name"),
+        (sync_rating, "rating_lookup_name"),
+        (sync_review, "review_lookup_name"),
+        (sync_pos, "position_lookup_name"),
+        (load_an, "an_lookup_name")
+    ]:
+        if sync_field and pref_name in pref_names and prefs[pref_name] not in lookup_names:
+            lookup_names.append(prefs[pref_name])
+
+    for lookup_name in lookup_names:
+        calibre_fields[lookup_name] = calibreAPI.all_field_for(lookup_name, calibre_book_IDs)
+
+
+def get_explorer_books(db):
+    # Load all folders and files from the reader database once, so books could be found by path without querying the database for every book
+    global explorer_books
+    explorer_books = {}
+    cursor = db.cursor()
+
+    # If there are duplicates, use the first folder with the name and the first file in the folder, as the per book queries did
+    folder_IDs = {}
+    for folder_row in cursor.execute("SELECT id, name FROM folders ORDER BY id").fetchall():
+        if folder_row["name"] not in folder_IDs:
+            folder_IDs[folder_row["name"]] = folder_row["id"]
+    folder_names = {folder_ID: folder_name for folder_name, folder_ID in folder_IDs.items()}
+
+    for file_row in cursor.execute("SELECT book_id, folder_id, filename FROM files").fetchall():
+        folder_name = folder_names.get(file_row["folder_id"])
+        if folder_name != None:
+            book_path = (folder_name, file_row["filename"])
+            if book_path not in explorer_books:
+                explorer_books[book_path] = file_row["book_id"]
+
+
+
+def get_books_settings(db):
+    # Load statuses and positions of all books for the current profile at once. Sync methods read them from here and update them after writing to the database.
+    global books_settings
+    books_settings = {}
+    cursor = db.cursor()
+    settings_rows = cursor.execute(explorer_queries["select_books_settings"], (int(profile_ID),)).fetchall()
+    for settings_row in settings_rows:
+        if settings_row["bookid"] not in books_settings:
+            books_settings[settings_row["bookid"]] = settings_row
+
+
+
+def update_books_settings(reader_book_ID, values):
+    settings_row = books_settings.get(reader_book_ID)
+    if settings_row == None:
+        settings_row = {"bookid": reader_book_ID, "completed": None, "favorite": None, "position": None, "position_ts": None}
+        books_settings[reader_book_ID] = settings_row
+    settings_row.update(values)
+
 
 
 def get_int_timestamp(datetime):
@@ -842,7 +1440,7 @@ def get_int_timestamp(datetime):
 
 
 
-def create_shelfs_dicts(db):
+def create_shelfs_dicts(db, calibre_book_IDs=None):
     global shelf_dicts
     cursor = db.cursor()
 
@@ -855,33 +1453,143 @@ def create_shelfs_dicts(db):
     if calibreShelfIDs == None:
         calibreShelfIDs = []
 
-    readerShelfRows = cursor.execute("SELECT id, name FROM bookshelfs").fetchall()
+    # Get names of all Calibre collections at once
+    calibreShelfNames = calibreAPI.get_id_map(prefs["shelf_lookup_name"])
+
+    # Group reader collections by name, so that each Calibre collection finds its reader collections by one lookup
+    readerShelfRowsByName = {}
+    for readerShelf in cursor.execute("SELECT id, name FROM bookshelfs"):
+        readerShelfRowsByName.setdefault(readerShelf["name"], []).append(readerShelf)
 
     for calibreShelfID in calibreShelfIDs:
-        shelfName = calibreAPI.get_item_name(prefs["shelf_lookup_name"], calibreShelfID)
+        shelfName = calibreShelfNames.get(calibreShelfID)
         readerShelfID = None
 
-        i = 0
-        while i < len(readerShelfRows):
-            readerShelf = readerShelfRows[i]
-            if readerShelf['name'] == shelfName:
-                readerShelfID = readerShelf["id"]
-                shelf_dicts["shelfsReaderToCalibre"][readerShelfID] = {"calibreShelfID": calibreShelfID, "name": shelfName}
-                del readerShelfRows[i]
-            else:
-                i += 1
+        for readerShelf in readerShelfRowsByName.pop(shelfName, []):
+            readerShelfID = readerShelf["id"]
+            shelf_dicts["shelfsReaderToCalibre"][readerShelfID] = {"calibreShelfID": calibreShelfID, "name": shelfName}
 
         shelf_dicts["shelfsNameToReader"][shelfName] = readerShelfID
-            
-    for readerShelf in readerShelfRows:
-        readerShelfID = readerShelf["id"]
-        shelfName = readerShelf["name"]
-        shelf_dicts["shelfsNameToReader"][shelfName] = readerShelfID
 
-        if readerShelfID != None:
-            shelf_dicts["shelfsReaderToCalibre"][readerShelfID] = {"calibreShelfID": None, "name": shelfName}
+    # Reader collections, that are not in Calibre
+    for readerShelfRows in readerShelfRowsByName.values():
+        for readerShelf in readerShelfRows:
+            readerShelfID = readerShelf["id"]
+            shelfName = readerShelf["name"]
+            shelf_dicts["shelfsNameToReader"][shelfName] = readerShelfID
 
+            if readerShelfID != None:
+                shelf_dicts["shelfsReaderToCalibre"][readerShelfID] = {"calibreShelfID": None, "name": shelfName}
 
+    # When collections are sent to reader, all collections that are missing on reader are created before the books are synced
+    if calibre_book_IDs != None:
+        create_missing_shelfs(db, calibre_book_IDs)
+
+
+
+def create_missing_shelfs(db, calibre_book_IDs):
+    cursor = db.cursor()
+    created = 0
+
+    for calibre_book_ID in calibre_book_IDs:
+        book = SyncBook(calibre_book_ID)
+        if book.device_book_metadata:
+            book.get_book_explorer_data(db)
+            if book.book_row:
+                for calibreBookShelfName in book.get_calibre_field(prefs["shelf_lookup_name"], default_value=[]):
+                    if shelf_dicts["shelfsNameToReader"][calibreBookShelfName] == None:
+                        # The collection gets the timestamp of the first book that is added to it
+                        cursor.execute(explorer_queries["insert_shelf"], (calibreBookShelfName, book.lastModTS))
+                        readerShelfID = cursor.lastrowid
+                        shelf_dicts["shelfsNameToReader"][calibreBookShelfName] = readerShelfID
+                        shelf_dicts["shelfsReaderToCalibre"][readerShelfID] = {"calibreShelfID": None, "name": calibreBookShelfName}
+                        created += 1
+
+    if created > 0:
+        db.commit()
+        print("PB-COLLECTIONS: Collections created on reader: " + str(created))
+
+
+
+
+
+class KRCollections():
+    # Collections of KOReader from collection.lua. Entries of every collection are kept as a list in their order,
+    # and the index of files keeps the names of collections where every book is, so a book is found without going through all collections.
+    # Numbered Lua tables are built again only for the changed collections, when the file is written.
+
+    def __init__(self, collections):
+        self.collections = collections
+        self.position = {}
+        self.settings = {}
+        self.entries = {}
+        self.files = {}
+        self.changed = set()
+        for name in collections:
+            self.index_collection(name)
+
+    def index_collection(self, name):
+        collection = self.collections[name]
+        self.position[name] = len(self.position)
+        self.settings[name] = None
+        self.entries[name] = []
+        if isinstance(collection, dict):
+            for key in collection:
+                if key == "settings":
+                    self.settings[name] = collection[key]
+                else:
+                    self.entries[name].append(collection[key])
+        elif isinstance(collection, list):
+            self.entries[name] = list(collection)
+        for entry in self.entries[name]:
+            if isinstance(entry, dict) and "file" in entry:
+                self.files.setdefault(entry["file"], set()).add(name)
+
+    def __len__(self):
+        return len(self.collections)
+
+    def __contains__(self, name):
+        return name in self.collections
+
+    def get_book_collections(self, file):
+        # Names of collections with the book, in the order of collections in the file
+        return sorted(self.files.get(file, ()), key=self.position.get)
+
+    def add_collection(self, name):
+        self.collections[name] = {}
+        self.index_collection(name)
+
+    def use_collection(self, name):
+        # Creates the collection if it is missing and gives it the default settings, as KOReader does
+        if name not in self.collections:
+            self.add_collection(name)
+        if self.settings[name] == None:
+            self.settings[name] = {"order": 1}
+        self.changed.add(name)
+
+    def add_book(self, name, file):
+        self.use_collection(name)
+        if name not in self.files.get(file, ()):
+            order = len(self.entries[name]) + 1
+            self.entries[name].append({"file": file, "order": order})
+            self.files.setdefault(file, set()).add(name)
+
+    def remove_book(self, name, file):
+        if name in self.files.get(file, ()):
+            self.entries[name] = [entry for entry in self.entries[name] if not (isinstance(entry, dict) and entry.get("file") == file)]
+            self.files[file].discard(name)
+            self.changed.add(name)
+
+    def to_table(self):
+        for name in self.changed:
+            collection = {}
+            if self.settings[name] != None:
+                collection["settings"] = self.settings[name]
+            for key, entry in enumerate(self.entries[name], 1):
+                collection[key] = entry
+            self.collections[name] = collection
+        self.changed = set()
+        return self.collections
 
 
 
@@ -891,13 +1599,14 @@ def get_kr_collections():
     kr_collections_path = device_main_storage + "applications/koreader/settings/collection.lua"
 
     if os.path.exists(kr_collections_path):
-        with open(kr_collections_path, 'r') as file:
-            content = str(file.read())
-        lua_content = re.sub('^[^{]*', '', content).strip()
         try:
-            kr_collections = lua.decode(lua_content)
-            if kr_collections == None:
-                kr_collections = {}
+            collections = read_lua_file(kr_collections_path)
+            # An empty file or "return nil" means there are no collections yet.
+            # A list is decoded only from a non-empty array-style table, which is not a valid collections file, so it is not synced and never written over.
+            if collections == None:
+                collections = {}
+            if isinstance(collections, dict):
+                kr_collections = KRCollections(collections)
         except:
             pass
 
@@ -907,27 +1616,229 @@ def create_missing_kr_collections():
     global kr_collections
     if kr_collections != None:
         shelfs = calibreAPI.all_field_names(prefs["shelf_lookup_name"])
-        kr_collections_list = list(kr_collections)
 
         for shelf in shelfs:
-            if shelf not in kr_collections_list:
-                kr_collections[shelf] = {}
+            if shelf not in kr_collections:
+                kr_collections.add_collection(shelf)
 
 
 
 def update_kr_collections(kr_collections):
     
-    kr_collections_path = device_main_storage + "applications/koreader/settings/collection.lua"
-    sidecar_lua = lua.encode(kr_collections)
-    sidecar_lua_formatted = "-- updated from Calibre\nreturn " + sidecar_lua + "\n"
+    if kr_collections != None:
+        kr_collections_path = device_main_storage + "applications/koreader/settings/collection.lua"
+        write_lua_file(kr_collections_path, kr_collections.to_table())
+
 
+
+class FolderEntry():
+    # The part of os.DirEntry used by the index, for Python 2, which has no os.scandir
+
+    def __init__(self, folder, name):
+        self.name = name
+        self.path = os.path.join(folder, name)
+
+    def is_dir(self):
+        return os.path.isdir(self.path)
+
+    def is_file(self):
+        return os.path.isfile(self.path)
+
+    def stat(self):
+        return os.stat(self.path)
+
+
+
+def scan_folder(folder):
     try:
-        with open(kr_collections_path, "w", encoding="utf-8") as f:
-            f.write(sidecar_lua_formatted)
-    except:
-        sidecar_lua_formatted = sidecar_lua_formatted.encode("utf-8")
-        with open(kr_collections_path, "w") as f:
-            f.write(sidecar_lua_formatted)
+        return list(os.scandir(folder))  # Python>3.5
+    except AttributeError:
+        return [FolderEntry(folder, name) for name in os.listdir(folder)]
+
+
+
+def index_kr_sidecars():
+    # Find all KOReader sidecars at once with scandir, instead of checking the possible paths of every book one by one.
+    # Sidecars are looked for in .sdr folders next to the books and in the docsettings folder of KOReader.
+    # The index maps the path of the sidecar on computer, normalized by kr_sidecar_key, to the path as it is on disk, its size and modification time.
+    global kr_sidecars
+    kr_sidecars = {}
+
+    book_folders = set()
+    for storage, lpath, size in device_books.values():
+        storage_path = device_card if storage == "card" else device_main_storage
+        if "/" in lpath:
+            book_folders.add(storage_path + lpath.rsplit('/', 1)[0] + "/")
+        else:
+            book_folders.add(storage_path)
+
+    for book_folder in book_folders:
+        try:
+            entries = scan_folder(book_folder)
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.name.endswith(".sdr") and entry.is_dir():
+                index_sdr_folder(book_folder + entry.name)
+
+    # Sidecars in docsettings are stored in folders that repeat the path of the book on device
+    folders = [device_main_storage + "applications/koreader/docsettings"]
+    while folders:
+        folder = folders.pop()
+        try:
+            entries = scan_folder(folder)
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.is_dir():
+                if entry.name.endswith(".sdr"):
+                    index_sdr_folder(folder + "/" + entry.name)
+                else:
+                    folders.append(folder + "/" + entry.name)
+
+    print("PB-COLLECTIONS: KOReader sidecars found: " + str(len(kr_sidecars)))
+
+
+
+def index_sdr_folder(sdr_path):
+    try:
+        entries = scan_folder(sdr_path)
+    except OSError:
+        return
+    for entry in entries:
+        if entry.name.startswith("metadata.") and entry.name.endswith(".lua") and entry.is_file():
+            stat = entry.stat()
+            sidecar_path = sdr_path + "/" + entry.name
+            kr_sidecars[kr_sidecar_key(sidecar_path)] = (sidecar_path, stat.st_size, stat.st_mtime)
+
+
+
+def kr_sidecar_key(path):
+    # Storage of the reader is FAT, where names do not depend on case, so the path of the book in Calibre may differ in case from the folders on disk
+    return os.path.normcase(path).lower()
+
+
+
+def find_kr_sidecar(path):
+    # Returns the path of the sidecar on disk, its size and modification time, or None if it is not found
+    return kr_sidecars.get(kr_sidecar_key(path))
+
+
+
+def read_lua_text(path):
+    with io.open(path, 'r', encoding="utf-8") as file:
+        content = file.read()
+    return re.sub('^[^{]*', '', content).strip()
+
+
+
+def read_lua_file(path, keys=None):
+    return lua.decode(read_lua_text(path), keys)
+
+
+
+class KRSidecar():
+    # KOReader sidecar of one book. It is parsed once, and written once by flush if anything was changed.
+    # If only some top level keys are needed, only they are decoded, and the rest is decoded by require_full if the whole table is needed.
+    # Values changed with set_value are spliced into the original text on flush, so the rest of the file is not encoded again.
+
+    def __init__(self, path, metadata=None, keys=None):
+        self.path = path
+        self.metadata = metadata
+        self.header = None
+        self.text = None
+        self.edits = []
+        self.dirty = False
+        if metadata == None and find_kr_sidecar(path) != None:
+            try:
+                with io.open(path, 'r', encoding="utf-8") as file:
+                    content = file.read()
+                body = re.sub('^[^{]*', '', content)
+                self.header = content[:len(content) - len(body)]
+                self.text = body.strip()
+                self.metadata = lua.decode(self.text, keys)
+            except (IOError, OSError, UnicodeDecodeError, ParseError) as e:
+                print("PB-COLLECTIONS: Can not read KOReader sidecar " + path + ": " + str(e))
+        if not isinstance(self.metadata, dict):
+            self.text = None
+
+    def require_full(self):
+        if isinstance(self.metadata, PartialTable):
+            try:
+                self.metadata = lua.decode(self.text)
+            except ParseError as e:
+                print("PB-COLLECTIONS: Can not read KOReader sidecar " + self.path + ": " + str(e))
+                self.metadata = None
+            if isinstance(self.metadata, dict):
+                for keys, value in self.edits:
+                    self.apply_edit(keys, value)
+            else:
+                self.metadata = None
+                self.text = None
+
+    def apply_edit(self, keys, value):
+        table = self.metadata
+        for key in keys[:-1]:
+            if isinstance(table.get(key), list):
+                table[key] = dict(enumerate(table[key]))
+            elif not isinstance(table.get(key), dict):
+                table[key] = {}
+            table = table[key]
+        table[keys[-1]] = value
+
+    def set_value(self, keys, value):
+        # Sets the value by the path of keys, missing tables on the path are created
+        if isinstance(self.metadata, dict):
+            self.apply_edit(keys, value)
+            self.edits.append((keys, value))
+            self.dirty = True
+
+    def changed(self):
+        # The metadata was changed directly, so the whole table will be written
+        self.require_full()
+        self.text = None
+        self.dirty = True
+
+    def flush(self):
+        if self.dirty:
+            text = self.text
+            for keys, value in self.edits:
+                if text != None:
+                    text = lua.set_value(text, keys, value)
+            make_dir(os.path.split(self.path)[0])
+            if text != None:
+                write_device_file(self.path, lambda write: write(self.header + text + "\n"))
+            else:
+                self.require_full()
+                if self.metadata == None:
+                    # Never replace a sidecar that could not be read, it would lose the reading progress and highlights
+                    print("PB-COLLECTIONS: KOReader sidecar is not written, because it can not be read: " + self.path)
+                    self.edits = []
+                    self.dirty = False
+                    return
+                write_lua_file(self.path, self.metadata)
+            stat = os.stat(self.path)
+            kr_sidecars[kr_sidecar_key(self.path)] = (self.path, stat.st_size, stat.st_mtime)
+            self.text = text
+            self.edits = []
+            self.dirty = False
+
+
+
+def write_lua_file(path, obj):
+    # The table is encoded straight into the file by chunks, so the whole Lua text is never built in memory
+    def write_content(write):
+        write("-- updated from Calibre\nreturn ")
+        lua.encode_to(obj, write)
+        write("\n")
+
+    write_device_file(path, write_content)
+
+
+
+def write_cr3hist(tree):
+    content = ET.tostring(tree.getroot())
+    write_device_file(cr3hist_path, lambda write: write(content))
 
 
 
@@ -973,6 +1884,7 @@ class SyncBook():
     def __init__(self, calibre_book_ID):
         self.calibre_book_ID = calibre_book_ID
         self.book_row = None
+        self.kr_sidecar = None
         self.get_device_book_metadata()
         self.new_annotations = {}
         self.annotations_html = None
@@ -981,159 +1893,151 @@ class SyncBook():
             
 
     def get_device_book_metadata(self):
-        # Find the book in Calibre metadata objects on device. We must check both the main storage and the card, it it is exist.
-        self.device_book_metadata = next((bookData for bookData in device_metadata_main if bookData["application_id"] == self.calibre_book_ID), None)
-        storage_prefix = storage_prefix_main                
-
-        if self.device_book_metadata == None and device_card:
-            self.device_book_metadata = next((bookData for bookData in device_metadata_card if bookData["application_id"] == self.calibre_book_ID), None)
-            storage_prefix = storage_prefix_card
+        # Find the book in the index of Calibre metadata on device. The index covers both the main storage and the card, if it is exist.
+        self.device_book_metadata = device_books.get(self.calibre_book_ID)
 
         if self.device_book_metadata:
-            bookPath = self.device_book_metadata["lpath"]
-            self.book_fullpath = storage_prefix + "/" + bookPath
-            self.book_filesize = self.device_book_metadata["size"]
+            storage, bookPath, self.book_filesize = self.device_book_metadata
+            # Path of the storage on device and where it is mounted on computer
+            self.storage_prefix = storage_prefix_main
+            self.storage_path = device_main_storage
+            if storage == "card":
+                self.storage_prefix = storage_prefix_card
+                self.storage_path = device_card
+            self.book_fullpath = self.storage_prefix + "/" + bookPath
 
             # Get the filename an folder of the book
 
-            self.bookPath_file = self.book_fullpath.rsplit('/', 1)[1].replace("'", r"''")
-            self.bookPath_folder = self.book_fullpath.rsplit('/', 1)[0].replace("'", r"''")
+            self.bookPath_file = self.book_fullpath.rsplit('/', 1)[1]
+            self.bookPath_folder = self.book_fullpath.rsplit('/', 1)[0]
 
     
 
+    def get_calibre_field(self, lookup_name, default_value=None):
+        if lookup_name in calibre_fields:
+            value = calibre_fields[lookup_name].get(self.calibre_book_ID)
+        else:
+            value = calibreAPI.field_for(lookup_name, self.calibre_book_ID)
+        if value == None:
+            return default_value
+        return value
+
+
+
     def get_book_explorer_data(self, db):
-        cursor = db.cursor()
         self.book_row = None
         
         # If bookData is found, it means it is on device and indexed by Calibre. Proceed to check if it is indexed by Pocketbook
         if self.device_book_metadata:
 
-            # Find the folder in Pocketbook database
-            book_folder_row = cursor.execute("SELECT id FROM folders WHERE name = '" + self.bookPath_folder + "'").fetchone()
+            # Find the book by folder and filename in the index of Pocketbook database
+            book_folder, book_file = self.book_fullpath.rsplit('/', 1)
+            reader_book_ID = explorer_books.get((book_folder, book_file))
 
-            if book_folder_row:
-                book_folder_id = str(book_folder_row["id"])
-
-                # Find the book in Pocketbook database
-                self.book_row = cursor.execute("SELECT book_id as id, filename FROM files WHERE folder_id = " + book_folder_id + " AND filename = '" + self.bookPath_file + "'").fetchone()
+            if reader_book_ID != None:
+                self.book_row = {"id": reader_book_ID, "filename": book_file}
             
         # If the book exist and indexed by Pocketbook proceed to sync metadata between the reader and Calibre
 
         if self.book_row:
-            self.reader_book_ID = str(self.book_row["id"])
 
             # Find the timestamp of the last modification in Calibre
-            lastMod = calibreAPI.field_for("last_modified", self.calibre_book_ID)
+            lastMod = self.get_calibre_field("last_modified")
             self.lastModTS = get_int_timestamp(lastMod)
         
 
 
-    def fix_missing_authors(self, db):
-        cursor = db.cursor()
-        if self.book_row and self.book_row["id"] in books_missing_authors_IDs:
-            title = calibreAPI.field_for("title", self.calibre_book_ID)
-            authors = calibreAPI.field_for("author_sort", self.calibre_book_ID, default_value=[])
-            authors_string = authors.replace(",", "").replace(" & ", ", ")
-            author_first = authors.split(" & ")[0].split(",")[0]
-            author_first_letter = author_first[0]
-            book_format = self.bookPath_file.rsplit('.', 1)[1] 
-
-            if book_format == "pdf":
-                title = calibreAPI.field_for("title", self.calibre_book_ID)
-                cursor.execute("UPDATE books_impl SET title = '" + title + "', author = '" + authors_string + "', firstauthor = '" + author_first + "', first_author_letter = '" + author_first_letter + "' WHERE id = " + self.reader_book_ID)
-            else:
-                cursor.execute("UPDATE books_impl SET author = '" + authors_string + "', firstauthor = '" + author_first + "', first_author_letter = '" + author_first_letter + "' WHERE id = " + self.reader_book_ID)
-            db.commit()
-        
-
-
     def process_db(self, db):
         self.get_book_explorer_data(db)
-        self.fix_missing_authors(db)
 
 
 
-    def get_kr_metadata(self):
-    
-        self.kr_metadata = None
+    # KOReader metadata of the book is read from the sidecar once. Changes are kept in memory and written by flush_kr_sidecar after the book is processed.
+
+    @property
+    def kr_metadata(self):
+        if self.kr_sidecar:
+            return self.kr_sidecar.metadata
+        return None
+
+    @property
+    def sidecar_path(self):
+        if self.kr_sidecar:
+            return self.kr_sidecar.path
+        return None
+
+
+
+    def get_kr_metadata(self, keys=None):
+        # When keys are given, only these top level keys of the sidecar are read. Without keys the whole sidecar is read.
+        if self.kr_sidecar:
+            if keys == None:
+                self.kr_sidecar.require_full()
+            return
+
+        if kr_sidecars == None:
+            index_kr_sidecars()
+
         format = self.book_fullpath.rsplit('.', 1)[1]
 
         # Look for sidecar in book folder
         sidecar_path_device = self.book_fullpath.rsplit('.', 1)[0] + ".sdr/metadata." + format + ".lua"
-        self.sidecar_path = sidecar_path_device.replace(storage_prefix_main + "/", device_main_storage)
-        
-        if storage_prefix_card:
-            self.sidecar_path = sidecar_path_device.replace(storage_prefix_card + "/", device_card)
+        sidecar_path = sidecar_path_device.replace(self.storage_prefix + "/", self.storage_path, 1)
 
-        if not os.path.exists(self.sidecar_path):
+        sidecar = find_kr_sidecar(sidecar_path)
+        if sidecar == None:
             # Look for sidecar in docsettings folder
-            self.sidecar_path = device_main_storage + "applications/koreader/docsettings" + sidecar_path_device
+            sidecar_path = device_main_storage + "applications/koreader/docsettings" + sidecar_path_device
+            sidecar = find_kr_sidecar(sidecar_path)
+        if sidecar != None:
+            sidecar_path = sidecar[0]
 
-        if os.path.exists(self.sidecar_path):
-            with open(self.sidecar_path, 'r') as file:
-                content = str(file.read())
-            lua_content = re.sub('^[^{]*', '', content).strip()
-            try:
-                self.kr_metadata = lua.decode(lua_content)
-            except:
-                pass
+        self.kr_sidecar = KRSidecar(sidecar_path, keys=keys)
 
 
 
+    def update_kr_sidecar(self):
+        self.kr_sidecar.changed()
 
-    
 
 
+    def set_kr_value(self, keys, value):
+        self.kr_sidecar.set_value(keys, value)
 
-    def update_kr_sidecar(self):
-        
-        sidecar_lua = lua.encode(self.kr_metadata)
-        sidecar_lua_formatted = "-- updated from Calibre\nreturn " + sidecar_lua + "\n"
-        try:
-            with open(self.sidecar_path, "w", encoding="utf-8") as f:
-                f.write(sidecar_lua_formatted)
-        except:
-            sidecar_lua_formatted = sidecar_lua_formatted.encode("utf-8")
-            with open(self.sidecar_path, "w") as f:
-                f.write(sidecar_lua_formatted)
+
+
+    def flush_kr_sidecar(self):
+        if self.kr_sidecar:
+            self.kr_sidecar.flush()
 
 
 
 
     def generate_kr_sidecar(self, position):
-        self.sidecar_path = None
+        sidecar_path = None
         format = self.book_fullpath.rsplit('.', 1)[1]
         kr_settings_reader_path = device_main_storage + "applications/koreader/settings.reader.lua"
 
         if os.path.exists(kr_settings_reader_path):
-            with open(kr_settings_reader_path, 'r') as file:
-                content = str(file.read())
-                lua_content = re.sub('^[^{]*', '', content).strip()
             try:
-                settings = lua.decode(lua_content)
+                settings = read_lua_file(kr_settings_reader_path)
                 metadata_folder = settings["document_metadata_folder"]
                 sidecar_path_device = self.book_fullpath.rsplit('.', 1)[0] + ".sdr/metadata." + format + ".lua"
                 if metadata_folder == "doc":
-                    self.sidecar_path = sidecar_path_device.replace(storage_prefix_main + "/", device_main_storage)
-                    if storage_prefix_card:
-                        self.sidecar_path = sidecar_path_device.replace(storage_prefix_card + "/", device_card)
+                    sidecar_path = sidecar_path_device.replace(self.storage_prefix + "/", self.storage_path, 1)
                 elif metadata_folder == "dir":
-                    self.sidecar_path = device_main_storage + "applications/koreader/docsettings" + sidecar_path_device
+                    sidecar_path = device_main_storage + "applications/koreader/docsettings" + sidecar_path_device
                 else:
                     pass
             except:
                 pass
 
-        if self.sidecar_path:
-            self.kr_metadata = {
+        if sidecar_path:
+            self.kr_sidecar = KRSidecar(sidecar_path, {
                 "cre_dom_version": 20240114,
                 "doc_path": self.book_fullpath,
                 "last_xpointer": position
-            }
-
-            dir = os.path.split(self.sidecar_path)[0]
-            make_dir(dir)
-
+            })
             self.update_kr_sidecar()
 
 
@@ -1141,69 +2045,19 @@ class SyncBook():
 
 
     def send_book_collections(self, db):
-        cursor = db.cursor()
-
         # Find the list of existing collections names for the book in Calibre
-        calibreBookShelfNames = calibreAPI.field_for(prefs["shelf_lookup_name"], self.calibre_book_ID, default_value=[])
+        calibreBookShelfNames = self.get_calibre_field(prefs["shelf_lookup_name"], default_value=[])
     
-        # Find the list of existing collections objects for the book on reader
-        readerBookShelfs = cursor.execute("SELECT bookshelfid, is_deleted, ts FROM bookshelfs_books WHERE bookid = " + self.reader_book_ID).fetchall()
+        readerBookShelfIDs = []
 
         # Check every collection in Calibre
         for calibreBookShelfName in calibreBookShelfNames:
 
-            # For each collection in Calibre find corresponding collection on reader
-            readerBookShelfID = shelf_dicts["shelfsNameToReader"][calibreBookShelfName]
-
-            # If the collection in reader does not exist we must create it
-            if readerBookShelfID == None:
-                # First create the collection itself
-                cursor.execute("INSERT INTO bookshelfs(name, is_deleted, ts) VALUES('" + calibreBookShelfName + "', 0, " + str(self.lastModTS) + ")")
-                db.commit()
-                readerBookShelfID = cursor.execute("SELECT id FROM bookshelfs WHERE name = '" + calibreBookShelfName +"'").fetchone()["id"]
-
-                # The add book to collection
-                cursor.execute("INSERT INTO bookshelfs_books(bookshelfid, bookid, ts, is_deleted) VALUES(" + str(readerBookShelfID) + ", " + self.reader_book_ID + ", " + str(self.lastModTS) + ", 0)")
-                db.commit()
-                
-            # If the collection in reader does exist, we must check if it has the book
-            else:
-                # Find the collection in the list of reader collections for the book 
-                readerBookShelf = None
-                for readerShelfRow in readerBookShelfs:
-                    if readerShelfRow["bookshelfid"] == readerBookShelfID:
-                        readerBookShelf = readerShelfRow
-
-                # If the book is in collection check if it is marked as deleted
-                if readerBookShelf:
-                    if readerBookShelf["is_deleted"]:
-                        # If deleted mark as not deleted
-                        cursor.execute("UPDATE bookshelfs_books SET is_deleted = 0, ts = " + str(self.lastModTS) + " WHERE bookid = " + self.reader_book_ID + " AND bookshelfid = " + str(readerBookShelfID))
-                        db.commit()
-
-                # If the book is not in collection, add it to collection
-                else:
-                    cursor.execute("INSERT INTO bookshelfs_books(bookshelfid, bookid, ts, is_deleted) VALUES(" + str(readerBookShelfID) + ", " + self.reader_book_ID + ", " + str(self.lastModTS) + ", 0)")
-                    db.commit()
-
-        # Check every collection in reader
-        for readerBookShelfRow in readerBookShelfs:
-
-            # Get collection name and id in reader
-            readerBookShelfID = readerBookShelfRow["bookshelfid"]
-            shelfName = shelf_dicts["shelfsReaderToCalibre"][readerBookShelfID]["name"]
-
-            # Look for the corresponding collection in Calibre
-            calibreShelf = None
-            for calibreBookShelfName in calibreBookShelfNames:
-                if calibreBookShelfName == shelfName:
-                    calibreShelf = calibreBookShelfName
+            # For each collection in Calibre find corresponding collection on reader. Missing collections are already created by create_shelfs_dicts.
+            readerBookShelfIDs.append(shelf_dicts["shelfsNameToReader"][calibreBookShelfName])
 
-            # If collection is not in Calibre and not marked as deleted in reader, we must mark it as deleted
-            if calibreShelf == None and readerBookShelfRow["is_deleted"] != 1:
-                cursor.execute("UPDATE bookshelfs_books SET is_deleted = 1, ts = " + str(self.lastModTS) + " WHERE bookid = " + self.reader_book_ID + " AND bookshelfid = " + str(readerBookShelfID))
-                db.commit()
-            # If collection is in Calibre, it is already processed, so do nothing.
+        # The book collections on reader are changed for all books at once when the database is closed
+        collection_sync.add_book(self.book_row["id"], self.lastModTS, readerBookShelfIDs)
 
 
 
@@ -1214,111 +2068,77 @@ class SyncBook():
         
         global kr_collections
         if kr_collections:
-            calibreBookShelfNames = calibreAPI.field_for(prefs["shelf_lookup_name"], self.calibre_book_ID, default_value=[])
+            calibreBookShelfNames = self.get_calibre_field(prefs["shelf_lookup_name"], default_value=[])
 
-            for c in kr_collections:
-                collection = kr_collections[c]
-                file_key = None
-                fixed = {}
-                count = 1
-                if c == "favorites":
-                    pass
-                elif c in calibreBookShelfNames:
-                    # Проверить, есть ли книга в коллекции, если нет, то добавить
-                    if "settings" not in collection:
-                        fixed["settings"] = {"order": 1}
-                    for key in collection:
-                        if key == "settings":
-                            fixed["settings"] = collection[key]
-                        else:
-                            fixed[count] = collection[key]
-                            count = count + 1
-                            if "file" in collection[key] and collection[key]["file"] == self.book_fullpath:
-                                file_key = key
-                    if file_key == None:
-                        next_key = len(fixed)
-                        fixed[next_key] = {"file": self.book_fullpath, "order": next_key}
-                    kr_collections[c] = fixed
-                else:
-                    # Проверить, есть ли книга в коллекции, если да, то удалить
-                    for key in collection:
-                        if key == "settings":
-                            fixed["settings"] = collection[key]
-                        elif "file" in collection[key] and collection[key]["file"] == self.book_fullpath:
-                            pass
-                        else:
-                            fixed[count] = collection[key]
-                            count = count + 1
-                    kr_collections[c] = fixed
+            # Add the book to collections from Calibre, that exist in KOReader
+            for c in calibreBookShelfNames:
+                if c != "favorites" and c in kr_collections:
+                    kr_collections.add_book(c, self.book_fullpath)
 
+            # Remove the book from other collections
+            for c in kr_collections.get_book_collections(self.book_fullpath):
+                if c != "favorites" and c not in calibreBookShelfNames:
+                    kr_collections.remove_book(c, self.book_fullpath)
 
 
 
-    def send_read_status(self, db):
-        cursor = db.cursor()
 
+    def send_read_status(self, db):
         # Find read status in Calibre
 
-        read = calibreAPI.field_for(prefs["read_lookup_name"], self.calibre_book_ID)
+        read = self.get_calibre_field(prefs["read_lookup_name"])
         completed = "0"
         if read: 
             completed = "1"
 
         # Find read status in reader
 
-        statusRow = cursor.execute("SELECT bookid, completed FROM books_settings WHERE bookid = " + self.reader_book_ID + " AND profileid = " + profile_ID).fetchone()
+        statusRow = books_settings.get(self.book_row["id"])
 
         # If status in reader exist and different from Calibre, update status in reader
         if statusRow:
             if completed != str(statusRow["completed"]):
-                cursor.execute("UPDATE books_settings SET completed = " + str(completed) + ", completed_ts = " + str(self.lastModTS) + " WHERE bookid = " + self.reader_book_ID + " AND profileid = " + profile_ID)
-                db.commit()
+                explorer_writer.execute(explorer_queries["update_read"], (int(completed), self.lastModTS, self.book_row["id"], int(profile_ID)))
+                update_books_settings(self.book_row["id"], {"completed": int(completed)})
         # If status in reader do not exist, insert new status row
         else:
-            cursor.execute("INSERT INTO books_settings(bookid, profileid, completed, completed_ts) VALUES(" + self.reader_book_ID + ", " + profile_ID + ", " + str(completed) + ", " + str(self.lastModTS) + ")")
-            db.commit()
+            explorer_writer.execute(explorer_queries["insert_read"], (self.book_row["id"], int(profile_ID), int(completed), self.lastModTS))
+            update_books_settings(self.book_row["id"], {"completed": int(completed)})
 
 
 
     def send_read_kr(self):
         read = False
         if self.kr_metadata:
-            read = calibreAPI.field_for(prefs['read_lookup_name'], self.calibre_book_ID, default_value=None)
+            read = self.get_calibre_field(prefs['read_lookup_name'], default_value=None)
         if read:
-            if "summary" not in self.kr_metadata:
-                self.kr_metadata["summary"] = {}
-            if "status" not in self.kr_metadata["summary"] or self.kr_metadata["summary"]["status"] != "complete":
-                self.kr_metadata["summary"]["status"] = "complete"
-                self.update_kr_sidecar()
+            summary = self.kr_metadata.get("summary")
+            if not isinstance(summary, dict) or summary.get("status") != "complete":
+                self.set_kr_value(["summary", "status"], "complete")
 
 
 
     def send_favorite_status(self, db):
-        cursor = db.cursor()
-
-        self.get_book_explorer_data(db)
-        self.fix_missing_authors(db)
-
         # Find favorite status in Calibre
 
-        fav = calibreAPI.field_for(prefs["fav_lookup_name"], self.calibre_book_ID)
+        fav = self.get_calibre_field(prefs["fav_lookup_name"])
         favorite = "0"
         if fav: 
             favorite = "1"
 
         # Find favorite status in reader
 
-        statusRow = cursor.execute("SELECT bookid, favorite FROM books_settings WHERE bookid = " + self.reader_book_ID + " AND profileid = " + profile_ID).fetchone()
+        statusRow = books_settings.get(self.book_row["id"])
 
         # If status in reader exist and different from Calibre, update status in reader
         if statusRow:
             if favorite != str(statusRow["favorite"]):
-                cursor.execute("UPDATE books_settings SET favorite = " + str(favorite) + ", favorite_ts = " + str(self.lastModTS) + " WHERE bookid = " + self.reader_book_ID + " AND profileid = " + profile_ID)
-                db.commit()
+                explorer_writer.execute(explorer_queries["update_fav"], (int(favorite), self.lastModTS, self.book_row["id"], int(profile_ID)))
+                update_books_settings(self.book_row["id"], {"favorite": int(favorite)})
         # If status in reader do not exist, insert new status row
         else:
-            cursor.execute("INSERT INTO books_settings(bookid, profileid, favorite, favorite_ts) VALUES(" + self.reader_book_ID + ", " + profile_ID + ", " + str(favorite) + ", " + str(self.lastModTS) + ")")
-            db.commit()
+            explorer_writer.execute(explorer_queries["insert_fav"], (self.book_row["id"], int(profile_ID), int(favorite), self.lastModTS))
+            update_books_settings(self.book_row["id"], {"favorite": int(favorite)})
 
 
 
@@ -1326,71 +2146,47 @@ class SyncBook():
     def send_fav_kr(self):
         global kr_collections
         if kr_collections:
-            favorite = calibreAPI.field_for(prefs['fav_lookup_name'], self.calibre_book_ID, default_value=None)
-            if "favorites" in kr_collections:
-                favorites = kr_collections["favorites"]
+            favorite = self.get_calibre_field(prefs['fav_lookup_name'], default_value=None)
+            if favorite:
+                kr_collections.add_book("favorites", self.book_fullpath)
             else:
-                favorites = {}
-            file_key = None
-            favorites_fixed = {}
-            count = 1
-            if "settings" not in favorites:
-                favorites_fixed["settings"] = {"order": 1}
-            for key in favorites:
-                if key == "settings":
-                    favorites_fixed["settings"] = favorites[key]
-                elif "file" in favorites[key] and favorites[key]["file"] == self.book_fullpath:
-                    file_key = key
-                    if favorite:
-                        favorites_fixed[count] = favorites[key]
-                        count = count + 1
-                    else:
-                        pass
-                else:
-                    favorites_fixed[count] = favorites[key]
-                    count = count + 1
-
-            if file_key == None and favorite:
-                next_key = len(favorites_fixed)
-                favorites_fixed[next_key] = {"file": self.book_fullpath, "order": next_key}
-                
-            kr_collections["favorites"] = favorites_fixed
+                kr_collections.use_collection("favorites")
+                kr_collections.remove_book("favorites", self.book_fullpath)
 
 
 
     def send_statuses(self, db):
-        cursor = db.cursor()
         completed = "0"
         favorite = "0"
 
-        read = calibreAPI.field_for(prefs["read_lookup_name"], self.calibre_book_ID)
+        read = self.get_calibre_field(prefs["read_lookup_name"])
         if read: 
             completed = "1"
 
-        fav = calibreAPI.field_for(prefs["fav_lookup_name"], self.calibre_book_ID)
+        fav = self.get_calibre_field(prefs["fav_lookup_name"])
         if fav: 
             favorite = "1"
         
         # Find statuses in reader
 
-        statusRow = cursor.execute("SELECT bookid, completed, favorite FROM books_settings WHERE bookid = " + self.reader_book_ID + " AND profileid = " + profile_ID).fetchone()
+        statusRow = books_settings.get(self.book_row["id"])
 
         # If any status in reader exist and different from Calibre, update statuses in reader
         if statusRow:
             if completed != str(statusRow["completed"]) or favorite != str(statusRow["favorite"]):
-                cursor.execute("UPDATE books_settings SET completed = " + str(completed) + ", completed_ts = " + str(self.lastModTS) + ", favorite = " + str(favorite) + ", favorite_ts = " + str(self.lastModTS) + " WHERE bookid = " + self.reader_book_ID + " AND profileid = " + profile_ID)
-                db.commit()
+                explorer_writer.execute(explorer_queries["update_statuses"], (int(completed), self.lastModTS, int(favorite), self.lastModTS, self.book_row["id"], int(profile_ID)))
+                update_books_settings(self.book_row["id"], {"completed": int(completed), "favorite": int(favorite)})
         # If statuses in reader do not exist, insert new status row
         else:
-            cursor.execute("INSERT INTO books_settings(bookid, profileid, completed, completed_ts, favorite, favorite_ts) VALUES(" + self.reader_book_ID + ", " + profile_ID + ", " + str(completed) + ", " + str(self.lastModTS) + ", " + str(favorite) + ", " + str(self.lastModTS) + ")")
-            db.commit()
+            explorer_writer.execute(explorer_queries["insert_statuses"], (self.book_row["id"], int(profile_ID), int(completed), self.lastModTS, int(favorite), self.lastModTS))
+            update_books_settings(self.book_row["id"], {"completed": int(completed), "favorite": int(favorite)})
 
 
 
     def send_rating_kr(self):
         rating = None
         if self.kr_metadata:
-            rating = calibreAPI.field_for(prefs['rating_lookup_name'], self.calibre_book_ID, default_value=None)
+            rating = self.get_calibre_field(prefs['rating_lookup_name'], default_value=None)
             if rating:
                 rating = rating/2
                 if rating % 1 != 0:
@@ -1398,25 +2194,21 @@ class SyncBook():
                 else: 
                     rating = int(rating)
         if rating:
-            if self.kr_metadata["summary"] == None:
-                self.kr_metadata["summary"] = {}
-            if "rating" not in self.kr_metadata["summary"] or self.kr_metadata["summary"]["rating"] != rating:
-                self.kr_metadata["summary"]["rating"] = rating
-                self.update_kr_sidecar()
+            summary = self.kr_metadata.get("summary")
+            if not isinstance(summary, dict) or summary.get("rating") != rating:
+                self.set_kr_value(["summary", "rating"], rating)
 
 
 
     def send_review_kr(self):
         review = None
         if self.kr_metadata:
-            review = calibreAPI.field_for(prefs["review_lookup_name"], self.calibre_book_ID, default_value=None)
+            review = self.get_calibre_field(prefs["review_lookup_name"], default_value=None)
         if review:
             review = review.replace("\n", "\\\n")
-            if self.kr_metadata["summary"] == None:
-                self.kr_metadata["summary"] = {}
-            if "note" not in self.kr_metadata["summary"] or self.kr_metadata["summary"]["note"] != review:
-                self.kr_metadata["summary"]["note"] = review
-                self.update_kr_sidecar()
+            summary = self.kr_metadata.get("summary")
+            if not isinstance(summary, dict) or summary.get("note") != review:
+                self.set_kr_value(["summary", "note"], review)
 
 
 
@@ -1434,13 +2226,13 @@ class SyncBook():
         update_shelfs_in_Calibre = False
 
         # Find the list of existing collections names for the book in Calibre
-        calibreBookShelfNames = calibreAPI.field_for(prefs["shelf_lookup_name"], self.calibre_book_ID, default_value=[])
+        calibreBookShelfNames = self.get_calibre_field(prefs["shelf_lookup_name"], default_value=[])
 
         # Create the editable copy of the collections in Calibre
         calibreBookShelfNamesList = list(calibreBookShelfNames)
 
         # Find the list of existing collections objects for the book on reader
-        readerBookShelfs = cursor.execute("SELECT bookshelfid, is_deleted, ts FROM bookshelfs_books WHERE bookid = " + self.reader_book_ID).fetchall()
+        readerBookShelfs = cursor.execute(explorer_queries["select_book_shelfs"], (self.book_row["id"],)).fetchall()
 
 
         # Check every collection in Calibre
@@ -1507,25 +2299,22 @@ class SyncBook():
         if kr_collections:
             update_shelfs_in_Calibre = False
             kr_collections_list = []
-            calibreBookShelfNames = calibreAPI.field_for(prefs["shelf_lookup_name"], self.calibre_book_ID, default_value=[])
+            calibreBookShelfNames = self.get_calibre_field(prefs["shelf_lookup_name"], default_value=[])
             calibreBookShelfNamesList = list(calibreBookShelfNames)
 
-            for c in kr_collections:
-                collection = kr_collections[c]
+            for c in kr_collections.get_book_collections(self.book_fullpath):
                 if c == "favorites":
                     pass
                 else:
-                    for key in collection:
-                        if "file" in collection[key] and collection[key]["file"] == self.book_fullpath:
-                            try:
-                                kr_collections_list.append(c.decode("utf-8"))
-                            except:
-                                kr_collections_list.append(c)
-                            
-                            if c not in calibreBookShelfNamesList:
-                                update_shelfs_in_Calibre = True
-                            else:
-                                calibreBookShelfNamesList.remove(c)
+                    try:
+                        kr_collections_list.append(c.decode("utf-8"))
+                    except:
+                        kr_collections_list.append(c)
+                    
+                    if c not in calibreBookShelfNamesList:
+                        update_shelfs_in_Calibre = True
+                    else:
+                        calibreBookShelfNamesList.remove(c)
             if len(calibreBookShelfNamesList) > 0:
                 update_shelfs_in_Calibre = True
 
@@ -1542,13 +2331,11 @@ class SyncBook():
         to_load_read = None
 
         if sync_read:
-            cursor = db.cursor()
-
             # Find read status in reader
-            statusRow = cursor.execute("SELECT bookid, completed FROM books_settings WHERE bookid = " + self.reader_book_ID + " AND profileid = " + profile_ID).fetchone()
+            statusRow = books_settings.get(self.book_row["id"])
 
             # If status exist, check the status in Calibre
-            read = calibreAPI.field_for(prefs["read_lookup_name"], self.calibre_book_ID)
+            read = self.get_calibre_field(prefs["read_lookup_name"])
             completed = "0"
             if read: 
                 completed = "1"
@@ -1584,7 +2371,7 @@ class SyncBook():
                         status = True
                     else:
                         status = False
-            read = calibreAPI.field_for(prefs["read_lookup_name"], self.calibre_book_ID)
+            read = self.get_calibre_field(prefs["read_lookup_name"])
             if read != status:
                 to_load_read = {"status": status}
         return to_load_read
@@ -1603,13 +2390,11 @@ class SyncBook():
         to_load_fav = None
 
         if sync_fav:
-            cursor = db.cursor()
-
             # Find favorite status in reader
-            statusRow = cursor.execute("SELECT bookid, favorite FROM books_settings WHERE bookid = " + self.reader_book_ID + " AND profileid = " + profile_ID).fetchone()
+            statusRow = books_settings.get(self.book_row["id"])
 
             # If status exist, check the status in Calibre
-            fav = calibreAPI.field_for(prefs["fav_lookup_name"], self.calibre_book_ID)
+            fav = self.get_calibre_field(prefs["fav_lookup_name"])
             favorite = "0"
             if fav: 
                 favorite = "1"
@@ -1639,13 +2424,8 @@ class SyncBook():
     def load_fav_kr(self):
         to_load_fav = None
         if kr_collections: 
-            status = False 
-            if "favorites" in kr_collections:
-                favorites = kr_collections["favorites"]
-                for key in favorites:
-                    if "file" in favorites[key] and favorites[key]["file"] == self.book_fullpath:
-                        status = True
-            fav = calibreAPI.field_for(prefs["fav_lookup_name"], self.calibre_book_ID)
+            status = "favorites" in kr_collections.get_book_collections(self.book_fullpath)
+            fav = self.get_calibre_field(prefs["fav_lookup_name"])
             if fav != status:
                 to_load_fav = {"status": status}
         return to_load_fav
@@ -1657,26 +2437,25 @@ class SyncBook():
 
 
     def load_statuses(self, db):
-        cursor = db.cursor()
         to_load_statuses = {
             "read": None,
             "fav": None
         }
 
         # Find statuses in reader
-        statusRow = cursor.execute("SELECT bookid, completed, favorite FROM books_settings WHERE bookid = " + self.reader_book_ID + " AND profileid = " + profile_ID).fetchone()
+        statusRow = books_settings.get(self.book_row["id"])
 
         # If at least one status exist, check statuses in Calibre
         completed = "0"
         favorite = "0"
 
         if sync_read:
-            read = calibreAPI.field_for(prefs["read_lookup_name"], self.calibre_book_ID)
+            read = self.get_calibre_field(prefs["read_lookup_name"])
             if read: 
                 completed = "1"
 
         if sync_fav:
-            fav = calibreAPI.field_for(prefs["fav_lookup_name"], self.calibre_book_ID)
+            fav = self.get_calibre_field(prefs["fav_lookup_name"])
             if fav: 
                 favorite = "1"
 
@@ -1730,7 +2509,7 @@ class SyncBook():
             if "summary" in self.kr_metadata:
                 if "rating" in self.kr_metadata["summary"]:
                     rating = self.kr_metadata["summary"]["rating"] * 2
-                    calibre_rating = calibreAPI.field_for(prefs['rating_lookup_name'], self.calibre_book_ID, default_value=None)
+                    calibre_rating = self.get_calibre_field(prefs['rating_lookup_name'], default_value=None)
                     if rating != calibre_rating:
                         to_load_rating = rating
         return to_load_rating
@@ -1753,7 +2532,7 @@ class SyncBook():
                         review = self.kr_metadata["summary"]["note"].decode("utf-8").replace("\\\n", "\n")
                     except:
                         review = self.kr_metadata["summary"]["note"].replace("\\\n", "\n")
-                    calibre_review = calibreAPI.field_for(prefs['review_lookup_name'], self.calibre_book_ID, default_value=None)
+                    calibre_review = self.get_calibre_field(prefs['review_lookup_name'], default_value=None)
                     if review != calibre_review:
                         to_load_review = review
         return to_load_review
@@ -2034,7 +2813,7 @@ class SyncBook():
 
     def get_existing_annotations(self):
         self.existing_annotations = {}
-        raw_annotations = calibreAPI.field_for(prefs["an_lookup_name"], self.calibre_book_ID)
+        raw_annotations = self.get_calibre_field(prefs["an_lookup_name"])
 
         if (raw_annotations):
             raw_annotations = raw_annotations.replace("<br>", "<br></br>").replace('<hr width="80%" style="background-color:#777;">', '<hr width="80%" style="background-color:#777;"></hr>')
@@ -2066,7 +2845,7 @@ class SyncBook():
 
     def pb_sync_position(self, db):
 
-        calibre_position_string = calibreAPI.field_for(prefs["position_lookup_name"], self.calibre_book_ID)
+        calibre_position_string = self.get_calibre_field(prefs["position_lookup_name"])
         calibre_position_pb = None
 
         if calibre_position_string != None:
@@ -2077,8 +2856,7 @@ class SyncBook():
                 calibre_ts = calibre_position_pb.split("_TIMESTAMP_")[1]
                 calibre_ts_int = int(calibre_ts)
 
-        cursor = db.cursor()
-        reader_position_row = cursor.execute("SELECT position, position_ts FROM books_settings WHERE bookid = " + self.reader_book_ID + " AND profileid = " + profile_ID).fetchone()
+        reader_position_row = books_settings.get(self.book_row["id"])
         reader_position_string = None
 
 
@@ -2089,8 +2867,8 @@ class SyncBook():
             
             
         if reader_position_row == None and calibre_position_pb:
-            cursor.execute("INSERT INTO books_settings(bookid, profileid, position, position_ts) VALUES(" + self.reader_book_ID + ", " + profile_ID + ", '" + calibre_position + "', " + calibre_ts + ")")
-            db.commit()
+            explorer_writer.execute(explorer_queries["insert_position"], (self.book_row["id"], int(profile_ID), calibre_position, int(calibre_ts)))
+            update_books_settings(self.book_row["id"], {"position": calibre_position, "position_ts": int(calibre_ts)})
             return None
 
         elif reader_position_row and reader_position_row["position"] and calibre_position_pb == None:
@@ -2099,8 +2877,8 @@ class SyncBook():
         elif reader_position_row and calibre_position_pb and calibre_position_pb != reader_position_string:
 
             if reader_position_row["position"] == None or calibre_ts_int > reader_ts_int:
-                cursor.execute("UPDATE books_settings SET position = '" + calibre_position + "', position_ts = " + calibre_ts + " WHERE bookid = " + self.reader_book_ID + " AND profileid = " + profile_ID)
-                db.commit()
+                explorer_writer.execute(explorer_queries["update_position"], (calibre_position, int(calibre_ts), self.book_row["id"], int(profile_ID)))
+                update_books_settings(self.book_row["id"], {"position": calibre_position, "position_ts": int(calibre_ts)})
                 return None
             
             elif calibre_ts_int < reader_ts_int:
@@ -2113,7 +2891,7 @@ class SyncBook():
 
     def kr_sync_position(self):
 
-        calibre_position_string = calibreAPI.field_for(prefs["position_lookup_name"], self.calibre_book_ID)
+        calibre_position_string = self.get_calibre_field(prefs["position_lookup_name"])
         calibre_position_kr = None
         position = None
 
@@ -2126,23 +2904,21 @@ class SyncBook():
 
         if self.kr_metadata:
             position = self.kr_metadata["last_xpointer"]
-            reader_ts = int(os.path.getmtime(self.sidecar_path))
+            reader_ts = int(find_kr_sidecar(self.sidecar_path)[2])
             reader_position_string = position + "_TIMESTAMP_" + str(reader_ts)
 
         if position and calibre_position_kr == None:
             return reader_position_string
         
-        elif not os.path.exists(self.sidecar_path) and calibre_position_kr:
+        elif find_kr_sidecar(self.sidecar_path) == None and calibre_position_kr:
             self.generate_kr_sidecar(calibre_position_text)
         
         elif self.kr_metadata and position == None and calibre_position_kr:
-            self.kr_metadata["last_xpointer"] = calibre_position_text
-            self.update_kr_sidecar()
+            self.set_kr_value(["last_xpointer"], calibre_position_text)
 
         elif position and calibre_position_kr and calibre_position_kr != reader_position_string:
             if calibre_ts > reader_ts:
-                self.kr_metadata["last_xpointer"] = calibre_position_text
-                self.update_kr_sidecar()
+                self.set_kr_value(["last_xpointer"], calibre_position_text)
             elif calibre_ts < reader_ts:
                 return reader_position_string
             
@@ -2157,11 +2933,11 @@ class SyncBook():
             make_dir(cr3hist_dir)
             root = ET.Element("FictionBookMarks")
             tree = ET.ElementTree(root)
-            tree.write(cr3hist_path)
+            write_cr3hist(tree)
 
         # Get position from Calibre
 
-        calibre_position_string = calibreAPI.field_for(prefs["position_lookup_name"], self.calibre_book_ID)
+        calibre_position_string = self.get_calibre_field(prefs["position_lookup_name"])
         calibre_position_cr = None
 
         if calibre_position_string != None:
@@ -2172,8 +2948,8 @@ class SyncBook():
 
         # Get position string from reader
 
-        bookPath_folder = self.bookPath_folder.replace("''", "'") + "/"
-        bookPath_file = self.bookPath_file.replace("''", "'")
+        bookPath_folder = self.bookPath_folder + "/"
+        bookPath_file = self.bookPath_file
         book_file = None
         position_bookmark = None
         tree = ET.parse(cr3hist_path)
@@ -2225,7 +3001,7 @@ class SyncBook():
             bookmark.set("timestamp", str(calibre_ts))
             start_point = ET.SubElement(bookmark, "start-point")
             start_point.text = calibre_position_text
-            tree.write(cr3hist_path)
+            write_cr3hist(tree)
 
             return None
 
@@ -2240,7 +3016,7 @@ class SyncBook():
                 calibre_position_text = calibre_position_cr.split("_TIMESTAMP_")[0]
                 start_point.text = calibre_position_text
                 position_bookmark.set('timestamp', str(calibre_ts))
-                tree.write(cr3hist_path)
+                write_cr3hist(tree)
 
                 return None
                 
@@ -2259,7 +3035,7 @@ class SyncBook():
 
 
     def pb_force_position(self, db):
-        calibre_position_string = calibreAPI.field_for(prefs["position_lookup_name"], self.calibre_book_ID)
+        calibre_position_string = self.get_calibre_field(prefs["position_lookup_name"])
         calibre_position_pb = None
 
         if calibre_position_string != None:
@@ -2269,17 +3045,16 @@ class SyncBook():
                 calibre_position = calibre_position_pb.split("_TIMESTAMP_")[0]
                 calibre_ts = calibre_position_pb.split("_TIMESTAMP_")[1]
 
-        cursor = db.cursor()
-        reader_position_row = cursor.execute("SELECT position, position_ts FROM books_settings WHERE bookid = " + self.reader_book_ID + " AND profileid = " + profile_ID).fetchone()
+        reader_position_row = books_settings.get(self.book_row["id"])
         
 
         if reader_position_row == None and calibre_position_pb:
-            cursor.execute("INSERT INTO books_settings(bookid, profileid, position, position_ts) VALUES(" + self.reader_book_ID + ", " + profile_ID + ", '" + calibre_position + "', " + calibre_ts + ")")
-            db.commit()
+            explorer_writer.execute(explorer_queries["insert_position"], (self.book_row["id"], int(profile_ID), calibre_position, int(calibre_ts)))
+            update_books_settings(self.book_row["id"], {"position": calibre_position, "position_ts": int(calibre_ts)})
 
         elif reader_position_row and calibre_position_pb and calibre_position != reader_position_row["position"]:
-            cursor.execute("UPDATE books_settings SET position = '" + calibre_position + "', position_ts = " + calibre_ts + " WHERE bookid = " + self.reader_book_ID + " AND profileid = " + profile_ID)
-            db.commit()
+            explorer_writer.execute(explorer_queries["update_position"], (calibre_position, int(calibre_ts), self.book_row["id"], int(profile_ID)))
+            update_books_settings(self.book_row["id"], {"position": calibre_position, "position_ts": int(calibre_ts)})
             
         return None
 
@@ -2287,7 +3062,7 @@ class SyncBook():
 
     def kr_force_position(self):
 
-        calibre_position_string = calibreAPI.field_for(prefs["position_lookup_name"], self.calibre_book_ID)
+        calibre_position_string = self.get_calibre_field(prefs["position_lookup_name"])
         calibre_position_kr = None
         position = None
 
@@ -2301,8 +3076,7 @@ class SyncBook():
             position = self.kr_metadata["last_xpointer"]
         
             if calibre_position_kr and position != calibre_position_text:
-                self.kr_metadata["last_xpointer"] = calibre_position_text
-                self.update_kr_sidecar()
+                self.set_kr_value(["last_xpointer"], calibre_position_text)
 
         elif calibre_position_kr:
             self.generate_kr_sidecar(calibre_position_text)
@@ -2320,11 +3094,11 @@ class SyncBook():
             make_dir(cr3hist_dir)
             root = ET.Element("FictionBookMarks")
             tree = ET.ElementTree(root)
-            tree.write(cr3hist_path)
+            write_cr3hist(tree)
 
         # Get position from Calibre
 
-        calibre_position_string = calibreAPI.field_for(prefs["position_lookup_name"], self.calibre_book_ID)
+        calibre_position_string = self.get_calibre_field(prefs["position_lookup_name"])
         calibre_position_cr = None
 
         if calibre_position_string != None:
@@ -2335,8 +3109,8 @@ class SyncBook():
 
         # Get position string from reader
 
-        bookPath_folder = self.bookPath_folder.replace("''", "'") + "/"
-        bookPath_file = self.bookPath_file.replace("''", "'")
+        bookPath_folder = self.bookPath_folder + "/"
+        bookPath_file = self.bookPath_file
         book_file = None
         position_bookmark = None
         tree = ET.parse(cr3hist_path)
@@ -2381,14 +3155,14 @@ class SyncBook():
             bookmark.set("timestamp", str(calibre_ts))
             start_point = ET.SubElement(bookmark, "start-point")
             start_point.text = calibre_position_text
-            tree.write(cr3hist_path)
+            write_cr3hist(tree)
 
         elif position_bookmark != None and calibre_position_cr != None and calibre_position_cr != reader_position_string:
             calibre_ts = int(calibre_position_cr.split("_TIMESTAMP_")[1])
             calibre_position_text = calibre_position_cr.split("_TIMESTAMP_")[0]
             start_point.text = calibre_position_text
             position_bookmark.set('timestamp', str(calibre_ts))
-            tree.write(cr3hist_path)
+            write_cr3hist(tree)
 
         return None
 
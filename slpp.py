@@ -43,10 +43,52 @@ def sequential(lst):
     return True
 
 
+def table(o):
+    if len([key for key in o if isinstance(key, six.string_types + (float,  bool, tuple))]) == 0:
+        so = sorted([key for key in o])
+        if sequential(so):
+            ar = []
+            for key in o:
+                ar.insert(key, o[key])
+            o = ar
+    return o
+
+
 class ParseError(Exception):
     pass
 
 
+class FallBack(Exception):
+    pass
+
+
+# Tokens of the fast decoder. It only accepts the plain Lua written by KOReader and by this plugin
+# (double quoted strings, decimal and hex numbers, names, braces and brackets), anything else is left to the slow decoder.
+STRING = r'"[^"\\]*(?:\\.[^"\\]*)*"'
+NUMBER = r'(?:0[xX][0-9A-Fa-f]+|-?[0-9]+(?:\.[0-9]+)?(?:[eE][+-][0-9]+)?)(?![\w.])'
+WORD = r'[A-Za-z_]\w*'
+token_re = re.compile(r'\s*(?:(%s)|(%s)|(%s)|([{}\[\]=,]))' % (STRING, NUMBER, WORD), re.S)
+key_re = re.compile(r'(%s|%s|%s)\]' % (STRING, NUMBER, WORD), re.S)
+entry_re = re.compile(r'\s*\[(%s|%s)\]\s*=\s*(?:(%s)|(%s)|(%s))\s*,?' % (STRING, NUMBER, STRING, NUMBER, WORD), re.S)
+escape_re = re.compile(r'\\(.)', re.S)
+# Entries of a skipped table, that are keys with plain values or plain positional values
+skip_re = re.compile(r'(?:\s*\[(?:%s|%s)\]\s*=\s*(?:%s|%s|(?:true|false|nil)(?!\w))\s*,?|\s*(?:%s|%s)\s*,)*' % (STRING, NUMBER, STRING, NUMBER, STRING, NUMBER), re.S)
+
+
+class PartialTable(dict):
+    # Table of which only the requested keys were decoded.
+    # It is true if the whole table has any entries, as the fully decoded table would be.
+
+    def __init__(self, values, has_entries):
+        dict.__init__(self, values)
+        self.has_entries = has_entries
+
+    def __bool__(self):
+        return self.has_entries
+
+    __nonzero__ = __bool__
+
+
 class SLPP(object):
 
     def __init__(self):
@@ -60,9 +102,24 @@ class SLPP(object):
         self.newline = '\n'
         self.tab = '\t'
 
-    def decode(self, text):
+    def decode(self, text, keys=None):
+        # If keys are given and the text is a table, only these keys of the table are decoded and the bodies of other values are skipped.
+        # When it can not be done safely, the whole table is decoded.
         if not text or not isinstance(text, six.string_types):
             return
+        try:
+            if keys is not None:
+                return self.fast_decode_keys(text, keys)
+            return self.fast_decode(text)
+        except FallBack:
+            pass
+        # The old parser also fails with errors of Python on some broken texts, they are given as ParseError too
+        try:
+            return self.slow_decode(text)
+        except (ValueError, TypeError, AttributeError, IndexError) as e:
+            raise ParseError(e)
+
+    def slow_decode(self, text):
         self.text = text
         self.at, self.ch, self.depth = 0, '', 0
         self.len = len(text)
@@ -71,45 +128,62 @@ class SLPP(object):
         return result
 
     def encode(self, obj):
-        self.depth = 0
-        return self.__encode(obj)
+        chunks = []
+        self.encode_to(obj, chunks.append)
+        return ''.join(chunks)
 
-    def __encode(self, obj):
-        s = ''
-        tab = self.tab
-        newline = self.newline
+    def encode_to(self, obj, write):
+        # Writes the encoded object by chunks to the write function (list append or file write) in one pass
+        self.__encode_to(obj, write, 0)
 
+    def __encode_to(self, obj, write, depth):
         if isinstance(obj, str):
-            s += '"%s"' % obj.replace(r'"', r'\"')
+            write('"')
+            write(obj.replace(r'"', r'\"'))
+            write('"')
         elif six.PY2 and isinstance(obj, unicode):
-            s += '"%s"' % obj.encode('utf-8').replace(r'"', r'\"')
+            write('"')
+            write(obj.encode('utf-8').replace(r'"', r'\"'))
+            write('"')
         elif six.PY3 and isinstance(obj, bytes):
-            s += '"{}"'.format(''.join(r'\x{:02x}'.format(c) for c in obj))
+            write('"{}"'.format(''.join(r'\x{:02x}'.format(c) for c in obj)))
         elif isinstance(obj, bool):
-            s += str(obj).lower()
+            write(str(obj).lower())
         elif obj is None:
-            s += 'nil'
+            write('nil')
         elif isinstance(obj, Number):
-            s += str(obj)
+            write(str(obj))
         elif isinstance(obj, (list, tuple, dict)):
-            self.depth += 1
-            if len(obj) == 0 or (not isinstance(obj, dict) and len([
-                    x for x in obj
-                    if isinstance(x, Number) or (isinstance(x, six.string_types) and len(x) < 10)
-               ]) == len(obj)):
+            depth += 1
+            tab = self.tab
+            newline = self.newline
+            if len(obj) == 0 or (not isinstance(obj, dict) and all(
+                    isinstance(x, Number) or (isinstance(x, six.string_types) and len(x) < 10) for x in obj)):
                 newline = tab = ''
-            dp = tab * self.depth
-            s += "%s{%s" % (tab * (self.depth - 2), newline)
+            dp = tab * depth
+            separator = ',' + newline
+            write(tab * (depth - 2))
+            write('{')
+            write(newline)
+            first = True
             if isinstance(obj, dict):
-                key_list = ['[%s]' if isinstance(k, Number) else '["%s"]' for k in obj.keys()]
-                contents = [dp + (key + ' = %s') % (k, self.__encode(v)) for (k, v), key in zip(obj.items(), key_list)]
-                s += (',%s' % newline).join(contents)
+                for k, v in obj.items():
+                    if not first:
+                        write(separator)
+                    first = False
+                    write(dp)
+                    write(('[%s] = ' if isinstance(k, Number) else '["%s"] = ') % (k,))
+                    self.__encode_to(v, write, depth)
             else:
-                s += (',%s' % newline).join(
-                    [dp + self.__encode(el) for el in obj])
-            self.depth -= 1
-            s += "%s%s}" % (newline, tab * self.depth)
-        return s
+                for el in obj:
+                    if not first:
+                        write(separator)
+                    first = False
+                    write(dp)
+                    self.__encode_to(el, write, depth)
+            write(newline)
+            write(tab * (depth - 1))
+            write('}')
 
     def white(self):
         while self.ch:
@@ -214,14 +288,7 @@ class SLPP(object):
                     self.next_chr()
                     if k is not None:
                         o[idx] = k
-                    if len([key for key in o if isinstance(key, six.string_types + (float,  bool, tuple))]) == 0:
-                        so = sorted([key for key in o])
-                        if sequential(so):
-                            ar = []
-                            for key in o:
-                                ar.insert(key, o[key])
-                            o = ar
-                    return o  # or here
+                    return table(o)  # or here
                 else:
                     if self.ch == ',':
                         self.next_chr()
@@ -244,6 +311,354 @@ class SLPP(object):
         raise ParseError(ERRORS['unexp_end_table'])  # Bad exit here
 
     words = {'true': True, 'false': False, 'nil': None}
+
+    # The fast decoder reads the text token by token with one regex and must give the same result as the slow one.
+    # When it meets anything the slow decoder would read in its own way, it raises FallBack and the text is decoded again by the slow decoder.
+
+    def fast_decode(self, text):
+        m = token_re.match(text)
+        if not m or m.group(4) is not None and m.group(4) != '{':
+            raise FallBack
+        if m.group(4):
+            return self.fast_object(text, m.end())[0]
+        return self.fast_value(m)
+
+    def fast_decode_keys(self, text, keys):
+        m = token_re.match(text)
+        if not m or m.group(4) != '{':
+            return self.fast_decode(text)
+        return self.fast_select(text, m.end(), keys)
+
+    def fast_select(self, text, at, keys):
+        # Reads the top level table like fast_object, but keeps only the requested keys
+        o = {}
+        has_entries = False
+        match = token_re.match
+        match_entry = entry_re.match
+        while True:
+            m = match_entry(text, at)
+            if m:
+                at = m.end()
+                k = self.fast_value(match(m.group(1)))
+                v = self.fast_value(m, 2)
+                if k in keys:
+                    o[k] = v
+                has_entries = True
+                continue
+
+            m = match(text, at)
+            if not m:
+                raise FallBack
+            at = m.end()
+            punct = m.group(4)
+            if punct == ',':
+                continue
+            if punct == '{':
+                at = self.fast_skip(text, at)
+                has_entries = True
+                continue
+            if punct == '}':
+                return PartialTable(o, has_entries)
+            if punct == '[':
+                m = key_re.match(text, at)
+                if not m:
+                    raise FallBack
+                at = m.end()
+                k = self.fast_value(token_re.match(m.group(1)))
+            elif punct is None:
+                k = self.fast_value(m)
+            else:
+                raise FallBack
+
+            m = match(text, at)
+            if not m:
+                raise FallBack
+            at = m.end()
+            punct = m.group(4)
+            if punct == '=':
+                if k is None:
+                    raise FallBack
+                m = match(text, at)
+                if not m:
+                    raise FallBack
+                at = m.end()
+                if m.group(4) == '{':
+                    if k in keys:
+                        o[k], at = self.fast_object(text, at)
+                    else:
+                        at = self.fast_skip(text, at)
+                elif m.group(4) is None:
+                    v = self.fast_value(m)
+                    if k in keys:
+                        o[k] = v
+                else:
+                    raise FallBack
+                has_entries = True
+            elif punct == ',':
+                has_entries = True
+            elif punct == '}':
+                if k is not None:
+                    has_entries = True
+                return PartialTable(o, has_entries)
+            else:
+                raise FallBack
+
+    def fast_skip(self, text, at):
+        # Finds the end of a table without building it. It accepts the same text as fast_object.
+        match = token_re.match
+        match_skip = skip_re.match
+        while True:
+            at = match_skip(text, at).end()
+            m = match(text, at)
+            if not m:
+                raise FallBack
+            at = m.end()
+            punct = m.group(4)
+            if punct == ',':
+                continue
+            if punct == '{':
+                at = self.fast_skip(text, at)
+                continue
+            if punct == '}':
+                return at
+            if punct == '[':
+                m = key_re.match(text, at)
+                if not m:
+                    raise FallBack
+                at = m.end()
+                k = self.fast_value(token_re.match(m.group(1)))
+            elif punct is None:
+                k = self.fast_value(m)
+            else:
+                raise FallBack
+
+            m = match(text, at)
+            if not m:
+                raise FallBack
+            at = m.end()
+            punct = m.group(4)
+            if punct == '=':
+                if k is None:
+                    raise FallBack
+                m = match(text, at)
+                if not m:
+                    raise FallBack
+                at = m.end()
+                if m.group(4) == '{':
+                    at = self.fast_skip(text, at)
+                elif m.group(4) is None:
+                    self.fast_value(m)
+                else:
+                    raise FallBack
+            elif punct == '}':
+                return at
+            elif punct != ',':
+                raise FallBack
+
+    def fast_spans(self, text, at):
+        # Reads the table like fast_skip and finds where the values of its keys are in the text.
+        # Returns spans of the values by key (the last one, if the key is repeated) and the position of the closing brace.
+        spans = {}
+        match = token_re.match
+        match_entry = entry_re.match
+        while True:
+            m = match_entry(text, at)
+            if m:
+                at = m.end()
+                k = self.fast_value(match(m.group(1)))
+                self.fast_value(m, 2)
+                group = 2 if m.group(2) is not None else 3 if m.group(3) is not None else 4
+                spans[k] = (m.start(group), m.end(group), False)
+                if text[at - 1] == ',':
+                    continue
+                at = m.end(group)
+            else:
+                m = match(text, at)
+                if not m:
+                    raise FallBack
+                at = m.end()
+                punct = m.group(4)
+                if punct == ',':
+                    continue
+                if punct == '{':
+                    at = self.fast_skip(text, at)
+                elif punct == '}':
+                    return spans, m.start(4)
+                elif punct == '[':
+                    m = key_re.match(text, at)
+                    if not m:
+                        raise FallBack
+                    at = m.end()
+                    k = self.fast_value(token_re.match(m.group(1)))
+                elif punct is None:
+                    k = self.fast_value(m)
+                else:
+                    raise FallBack
+
+                if punct != '{':
+                    m = match(text, at)
+                    if not m:
+                        raise FallBack
+                    at = m.end()
+                    if m.group(4) == '=':
+                        if k is None:
+                            raise FallBack
+                        m = match(text, at)
+                        if not m:
+                            raise FallBack
+                        at = m.end()
+                        if m.group(4) == '{':
+                            start = m.start(4)
+                            at = self.fast_skip(text, at)
+                            spans[k] = (start, at, True)
+                        elif m.group(4) is None:
+                            self.fast_value(m)
+                            group = 1 if m.group(1) is not None else 2 if m.group(2) is not None else 3
+                            spans[k] = (m.start(group), m.end(group), False)
+                        else:
+                            raise FallBack
+                    elif k is None:
+                        # The old parser drops nil list items at the end of a table, adding an entry after them would bring them back
+                        raise FallBack
+                    else:
+                        at = m.start()
+
+            # Every entry must be followed by a comma or by the end of the table
+            m = match(text, at)
+            if not m:
+                raise FallBack
+            at = m.end()
+            if m.group(4) == '}':
+                return spans, m.start(4)
+            if m.group(4) != ',':
+                raise FallBack
+
+    def set_value(self, text, keys, value):
+        # Changes one value in the Lua text of a table and leaves the rest of the text as it is.
+        # keys is the path to the value, missing tables on the path are created. Returns None if the text can not be changed safely.
+        try:
+            m = token_re.match(text)
+            if not m or m.group(4) != '{':
+                return None
+            start = m.start(4)
+            for i, key in enumerate(keys):
+                spans, end = self.fast_spans(text, start + 1)
+                new_value = value
+                for next_key in reversed(keys[i + 1:]):
+                    new_value = {next_key: new_value}
+                if key in spans:
+                    value_start, value_end, is_table = spans[key]
+                    if is_table and i < len(keys) - 1:
+                        start = value_start
+                        continue
+                    return text[:value_start] + self.encode(new_value) + text[value_end:]
+                return self.insert_entry(text, start, end, key, self.encode(new_value))
+        except FallBack:
+            return None
+
+    def insert_entry(self, text, start, end, key, encoded_value):
+        # Adds the entry before the closing brace at end, in the line and with the indent of the last entry of the table
+        entry = ('[%s] = ' if isinstance(key, Number) else '["%s"] = ') % (key,) + encoded_value
+        last = end - 1
+        while last > start and text[last].isspace():
+            last -= 1
+        if last == start:
+            return text[:start + 1] + entry + text[start + 1:]
+        line_start = text.rfind('\n', 0, last) + 1
+        indent = re.match(r'[ \t]*', text[line_start:]).group(0)
+        if text[last] == ',':
+            return text[:last + 1] + '\n' + indent + entry + ',' + text[last + 1:]
+        return text[:last + 1] + ',\n' + indent + entry + text[last + 1:]
+
+    def fast_value(self, m, group=1):
+        string, number, word = m.group(group, group + 1, group + 2)
+        if string is not None:
+            string = string[1:-1]
+            if '\\' in string:
+                string = escape_re.sub(self.fast_escape, string)
+            return string
+        if number is not None:
+            try:
+                return int(number, 0)
+            except:
+                pass
+            return float(number)
+        if word in self.words:
+            return self.words[word]
+        if word.startswith(('true', 'false', 'nil')):
+            raise FallBack
+        return word
+
+    def fast_escape(self, m):
+        if m.group(1) == '"':
+            return '"'
+        return m.group(0)
+
+    def fast_object(self, text, at):
+        o = {}
+        idx = 0
+        match = token_re.match
+        match_entry = entry_re.match
+        while True:
+            # Most entries are keys with plain values, and they are read by one match
+            m = match_entry(text, at)
+            if m:
+                at = m.end()
+                o[self.fast_value(match(m.group(1)))] = self.fast_value(m, 2)
+                idx += 1
+                continue
+
+            m = match(text, at)
+            if not m:
+                raise FallBack
+            at = m.end()
+            punct = m.group(4)
+            if punct == ',':
+                continue
+            if punct == '{':
+                o[idx], at = self.fast_object(text, at)
+                idx += 1
+                continue
+            if punct == '}':
+                return table(o), at
+            if punct == '[':
+                m = key_re.match(text, at)
+                if not m:
+                    raise FallBack
+                at = m.end()
+                k = self.fast_value(token_re.match(m.group(1)))
+            elif punct is None:
+                k = self.fast_value(m)
+            else:
+                raise FallBack
+
+            m = match(text, at)
+            if not m:
+                raise FallBack
+            at = m.end()
+            punct = m.group(4)
+            if punct == '=':
+                m = match(text, at)
+                if not m:
+                    raise FallBack
+                at = m.end()
+                if m.group(4) == '{':
+                    o[k], at = self.fast_object(text, at)
+                elif m.group(4) is None:
+                    o[k] = self.fast_value(m)
+                else:
+                    raise FallBack
+                idx += 1
+            elif punct == ',':
+                o[idx] = k
+                idx += 1
+            elif punct == '}':
+                if k is not None:
+                    o[idx] = k
+                return table(o), at
+            else:
+                raise FallBack
+
     def word(self):
         s = ''
         if self.ch != '\n':
@@ -308,4 +723,4 @@ class SLPP(object):
 
 slpp = SLPP()
 
-__all__ = ['slpp']
+__all__ = ['slpp', 'PartialTable', 'ParseError']
@@ -177,7 +177,8 @@ class InterfacePlugin(InterfaceAction):
             data = {
                 "dbpath": self.gui.current_db.library_path,
                 "device_DB_path": device_DB_path,
-                "device_storages": self.get_device_storages()
+                "device_storages": self.get_device_storages(),
+                "device_books": self.get_device_books()
             }        
             
             args = ['calibre_plugins.pocketbook_collections.main', command, (data, )]
@@ -280,6 +281,38 @@ class InterfacePlugin(InterfaceAction):
 
 
 
+    # Calibre already has the lists of books on device in memory, so we pass the compact index of them to the job instead of making it read metadata.calibre from device
+
+    def get_device_books(self):
+        device_books = {}
+        device = self.gui.library_view.model().device_connected
+        if device:
+            try:
+                booklists = self.gui.booklists()
+            except:
+                return None
+
+            # Book lists are for the main storage, card A and card B, but only one card is synced
+            storages = ["main", None, None]
+            if self.gui.device_manager.connected_device._card_a_prefix:
+                storages[1] = "card"
+            elif self.gui.device_manager.connected_device._card_b_prefix:
+                storages[2] = "card"
+
+            for storage, booklist in zip(storages, booklists):
+                if storage and booklist:
+                    for book in booklist:
+                        application_id = getattr(book, "application_id", None)
+                        if application_id != None and application_id not in device_books:
+                            device_books[application_id] = (storage, book.lpath, book.size)
+
+        # If the lists are not loaded yet, the job will read metadata.calibre itself
+        if len(device_books) == 0:
+            return None
+        return device_books
+
+
+
 
 
 